@@ -0,0 +1,346 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+
+def get_recognition_site_loop(contigs, enzyme_site):
+    """
+    Reference implementation of process_fasta.get_recognition_site that compares the enzyme site to every position of
+    every contig. Used to check and time the faster implementation against.
+    :param contigs: Dictionary with format {'contig name' : 'sequence information'}
+    :param enzyme_site: String with one or more comma-separated DNA sequences recognised by the Enzymes used in cmap
+        creation.
+    :return: Dictionary with format: {'contig/cmap name' : [ordered list of enzyme site locations]}
+    """
+    import process_fasta as pf
+
+    sites = {}
+    enzyme_sites = [[site, pf.get_reverse_complement(site)[::-1]] for site in pf.get_enzyme_sites(enzyme_site)]
+    for seq in contigs:
+        sites[seq] = []
+        sequence = str(contigs[seq])
+        for i in range(len(sequence)):
+            for site, reverse_site in enzyme_sites:
+                if sequence[i:i + len(site)] == site or sequence[i:i + len(site)] == reverse_site:
+                    sites[seq].append(i + 1)
+                    break
+    return sites
+
+
+def get_idx_overlapping_fasta_locations_pairwise(sorted_data):
+    """
+    Reference implementation of functions_map_fasta_parallel.get_idx_overlapping_fasta_locations that compares every
+    pair of overlaps. Used to check and time the faster implementation against.
+    :param sorted_data: list with format [[[fasta_name, cmap_name, overlap_len], [fasta_locations], [cmap_locations]]]
+        sorted from longest to shortest overlap
+    :return: set with the indexes of the overlaps that should be removed
+    """
+    import numpy as np
+
+    delete_list = set([])
+
+    for i in range(len(sorted_data)):
+        if i in delete_list:
+            continue
+        for j in range(len(sorted_data)):
+            if (j in delete_list) or (i >= j):
+                continue
+            elif any(np.isin(sorted_data[i][1], sorted_data[j][1])):
+                delete_list.add(j)
+    return delete_list
+
+
+def random_chains(n_chains, n_locations, max_len, seed):
+    """
+    Generates random consecutive overlaps of one fasta contig, sorted from longest to shortest, to benchmark on
+    :param n_chains: number of overlaps to generate
+    :param n_locations: number of fasta position ids the overlaps are placed on
+    :param max_len: maximum length of an overlap
+    :param seed: seed for the random number generator
+    :return: list with format [[[fasta_name, cmap_name, overlap_len], [fasta_locations], [cmap_locations]]]
+    """
+    rng = random.Random(seed)
+    sorted_data = []
+    for i in range(n_chains):
+        length = rng.randint(1, max_len)
+        fasta_start = rng.randint(1, n_locations)
+        cmap_start = rng.randint(1, n_locations)
+        sorted_data.append([['fasta', 'cmap_{}'.format(i % 10), length],
+                            list(range(fasta_start, fasta_start + length + 1)),
+                            list(range(cmap_start, cmap_start + length + 1))])
+    sorted_data.sort(reverse=True, key=lambda sorted_data: sorted_data[0][2])
+    return sorted_data
+
+
+def random_contigs(n_contigs, contig_length, seed):
+    """
+    Generates random DNA sequences to benchmark on, in a SequenceStore like the contigs of a fasta file
+    :param n_contigs: number of sequences to generate
+    :param contig_length: length of each sequence
+    :param seed: seed for the random number generator
+    :return: SequenceStore with format {'contig name' : 'sequence information'}, including the reverse complements
+    """
+    import numpy as np
+    import process_fasta as pf
+
+    rng = random.Random(seed)
+    sequences = []
+    offsets = {}
+    for i in range(n_contigs):
+        offsets['contig_{}'.format(i + 1)] = (i * contig_length, contig_length)
+        sequences.append(''.join(rng.choices('ACGT', k=contig_length)))
+    return pf.SequenceStore(np.frombuffer(''.join(sequences).encode(), dtype=np.uint8), offsets)
+
+
+def benchmark_sites(args):
+    """
+    Times get_recognition_site against the per-base reference loop and checks that both find the same sites, on the
+    contigs and on their reverse complements
+    :param args: parsed command line arguments
+    :return: None
+    """
+    import process_fasta as pf
+
+    contigs = random_contigs(args.n_contigs, args.length, args.seed)
+
+    t = time.time()
+    reference = get_recognition_site_loop(contigs, args.Enzyme_site)
+    loop_time = time.time() - t
+
+    t = time.time()
+    sites = pf.get_recognition_site(contigs, args.Enzyme_site, args.n_threads)
+    scan_time = time.time() - t
+
+    if sites != reference:
+        print("get_recognition_site does not match the reference loop.")
+        sys.exit(1)
+    n_sites = sum(len(sites[seq]) for seq in sites)
+    print("Found {} sites in {} bp on both strands".format(n_sites, 2 * args.n_contigs * args.length))
+    print("Reference loop took: {}".format(loop_time))
+    print("get_recognition_site took: {}, speedup: {}".format(scan_time, loop_time / scan_time))
+
+
+def benchmark_chains(args):
+    """
+    Times get_idx_overlapping_fasta_locations against the pairwise reference and checks that both remove the same
+    overlaps
+    :param args: parsed command line arguments
+    :return: None
+    """
+    import functions_map_fasta_parallel as r
+
+    for seed in range(args.seed, args.seed + args.repeats):
+        sorted_data = random_chains(args.n_chains, args.n_locations, args.max_len, seed)
+
+        t = time.time()
+        reference = get_idx_overlapping_fasta_locations_pairwise(sorted_data)
+        pairwise_time = time.time() - t
+
+        t = time.time()
+        delete_list = r.get_idx_overlapping_fasta_locations(sorted_data)
+        bitmap_time = time.time() - t
+
+        if delete_list != reference:
+            print("get_idx_overlapping_fasta_locations does not match the reference for seed {}.".format(seed))
+            sys.exit(1)
+        print("Seed {}: kept {} of {} overlaps".format(seed, len(sorted_data) - len(delete_list), len(sorted_data)))
+        print("Pairwise reference took: {}".format(pairwise_time))
+        print("get_idx_overlapping_fasta_locations took: {}, speedup: {}".format(bitmap_time,
+                                                                               pairwise_time / bitmap_time))
+
+
+def read_fasta(path):
+    """
+    Reads all sequences of a fasta file
+    :param path: path to the fasta file
+    :return: dictionary with format {'name' : upper case sequence bytes}
+    """
+    sequences = {}
+    name = None
+    with open(path, 'rb') as file:
+        for line in file:
+            if line.startswith(b'>'):
+                name = line[1:].decode().strip()
+                sequences[name] = []
+            elif name is not None:
+                sequences[name].append(line.strip().upper())
+    return {name: b''.join(sequences[name]) for name in sequences}
+
+
+def get_kmers(sequence, k):
+    """
+    Encodes every k-mer of a sequence that contains only A, C, G and T as an integer, 2 bits per base
+    :param sequence: DNA sequence as bytes
+    :param k: k-mer size, at most 31
+    :return: numpy int64 array with the code of each k-mer
+    """
+    import numpy as np
+
+    lookup = np.full(256, 4, dtype=np.int64)
+    for code, base in enumerate(b'ACGT'):
+        lookup[base] = code
+    bases = lookup[np.frombuffer(sequence, dtype=np.uint8)]
+    n_kmers = len(bases) - k + 1
+    if n_kmers <= 0:
+        return np.zeros(0, dtype=np.int64)
+    invalid = np.concatenate([[0], np.cumsum(bases == 4)])
+    valid = invalid[k:] - invalid[:-k] == 0
+    codes = np.zeros(n_kmers, dtype=np.int64)
+    for j in range(k):
+        codes = codes * 4 + (bases[j:j + n_kmers] & 3)
+    return codes[valid]
+
+
+def assembly_accuracy(assembly, genome, truth, k=31):
+    """
+    Compares each scaffold to the genome segment its map was made from. Precision is the fraction of k-mers of the
+    scaffold that occur in the segment, recall the fraction of distinct k-mers of the segment that occur in the
+    scaffold.
+    :param assembly: path to the fasta file made by main.py
+    :param genome: path to the genome made by simulate_data.py
+    :param truth: path to the truth file made by simulate_data.py
+    :param k: k-mer size
+    :return: dictionary with the filled fraction, precision and recall over all scaffolds
+    """
+    import numpy as np
+    import simulate_data as sd
+
+    scaffolds = read_fasta(assembly)
+    chromosomes = read_fasta(genome)
+    counts = {'bases': 0, 'filled': 0, 'kmers': 0, 'correct_kmers': 0, 'segment_kmers': 0, 'found_kmers': 0}
+    for row_type, name, chromosome, start, end, strand in sd.read_truth(truth):
+        if row_type != 'map' or name not in scaffolds:
+            continue
+        scaffold = scaffolds[name]
+        scaffold_kmers = get_kmers(scaffold, k)
+        segment_kmers = np.unique(get_kmers(chromosomes[chromosome][start:end], k))
+        counts['bases'] += len(scaffold)
+        counts['filled'] += len(scaffold) - scaffold.count(b'N')
+        counts['kmers'] += len(scaffold_kmers)
+        counts['correct_kmers'] += int(np.isin(scaffold_kmers, segment_kmers).sum())
+        counts['segment_kmers'] += len(segment_kmers)
+        counts['found_kmers'] += int(np.isin(segment_kmers, scaffold_kmers).sum())
+    return {'filled': counts['filled'] / max(counts['bases'], 1),
+            'precision': counts['correct_kmers'] / max(counts['kmers'], 1),
+            'recall': counts['found_kmers'] / max(counts['segment_kmers'], 1)}
+
+
+def get_stage_times(metrics_path):
+    """
+    Sums the wall time of each stage over all rounds
+    :param metrics_path: path to the JSON lines file written by main.py --metrics
+    :return: dictionary with format {stage name: wall time}
+    """
+    stage_times = {}
+    with open(metrics_path) as file:
+        for line in file:
+            record = json.loads(line)
+            stage_times[record['stage']] = stage_times.get(record['stage'], 0) + record['wall_time']
+    return stage_times
+
+
+def benchmark_sweep(args):
+    """
+    Runs the whole pipeline on simulated data for each genome size and thread count, and reports the time of each
+    stage and the accuracy of the assembly against the simulated truth
+    :param args: parsed command line arguments
+    :return: None
+    """
+    import simulate_data as sd
+
+    main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+    results = []
+    for genome_size in [int(size) for size in args.genome_sizes.split(',')]:
+        size_dir = os.path.abspath(os.path.join(args.work_dir, 'genome_{}'.format(genome_size)))
+        os.makedirs(size_dir, exist_ok=True)
+        paths = sd.simulate(os.path.join(size_dir, 'sim'), genome_size, coverage=args.coverage,
+                            error_rate=args.error_rate, enzyme_site=args.Enzyme_site, jitter=args.jitter,
+                            seed=args.seed)
+        for n_threads in [int(n) for n in args.n_threads.split(',')]:
+            run_dir = os.path.join(size_dir, 'threads_{}'.format(n_threads))
+            os.makedirs(run_dir, exist_ok=True)
+            metrics_path = os.path.join(run_dir, 'metrics.jsonl')
+            if os.path.exists(metrics_path):
+                os.remove(metrics_path)
+            # every run gets its own cache, so the ingestion stages are timed too
+            command = [sys.executable, main_path, paths['reads'], paths['cmap'], args.Enzyme_site, 'out',
+                       '-c', str(n_threads), '--metrics', metrics_path, '--cache_dir', os.path.join(run_dir, 'cache')]
+            command += args.main_args.split()
+
+            t = time.time()
+            with open(os.path.join(run_dir, 'log.txt'), 'w') as log:
+                completed = subprocess.run(command, cwd=run_dir, stdout=log, stderr=subprocess.STDOUT)
+            total_time = time.time() - t
+            if completed.returncode != 0:
+                print("main.py failed for genome size {} with {} threads, see {}".format(
+                    genome_size, n_threads, os.path.join(run_dir, 'log.txt')))
+                sys.exit(1)
+
+            result = {'genome_size': genome_size, 'n_threads': n_threads, 'total_time': total_time}
+            result.update(get_stage_times(metrics_path))
+            result.update(assembly_accuracy(os.path.join(run_dir, 'out.fa'), paths['genome'], paths['truth']))
+            results.append(result)
+            print(json.dumps(result))
+
+    columns = []
+    for result in results:
+        columns += [column for column in result if column not in columns]
+    with open(args.output, 'w') as file:
+        file.write('\t'.join(columns) + '\n')
+        for result in results:
+            file.write('\t'.join(str(result.get(column, '')) for column in columns) + '\n')
+    print("Results written to: {}".format(args.output))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pipeline stages against their reference implementations.")
+    subparsers = parser.add_subparsers()
+
+    sites_parser = subparsers.add_parser("sites", help="Benchmark enzyme site detection on random sequences.")
+    sites_parser.add_argument("Enzyme_site", type=str, help="Recognition site of the enzyme to search for, or comma-separated sites of several enzymes.")
+    sites_parser.add_argument("--n_contigs", "-n", type=int, default=20, help="Number of random sequences.")
+    sites_parser.add_argument("--length", "-l", type=int, default=500000, help="Length of each random sequence.")
+    sites_parser.add_argument("--n_threads", "-c", type=int, default=1, help="Number of threads to use.")
+    sites_parser.add_argument("--seed", "-s", type=int, default=1, help="Seed for the random sequences.")
+    sites_parser.set_defaults(func=benchmark_sites)
+
+    chains_parser = subparsers.add_parser("chains", help="Benchmark the removal of overlaps with shared fasta "
+                                                         "locations on random overlaps.")
+    chains_parser.add_argument("--n_chains", "-n", type=int, default=2000, help="Number of random overlaps.")
+    chains_parser.add_argument("--n_locations", "-l", type=int, default=5000, help="Number of fasta position ids.")
+    chains_parser.add_argument("--max_len", "-m", type=int, default=20, help="Maximum length of an overlap.")
+    chains_parser.add_argument("--repeats", "-r", type=int, default=3, help="Number of random sets to check.")
+    chains_parser.add_argument("--seed", "-s", type=int, default=1, help="Seed for the first random set.")
+    chains_parser.set_defaults(func=benchmark_chains)
+
+    sweep_parser = subparsers.add_parser("sweep", help="Time every stage of the pipeline on simulated data at several "
+                                                       "genome sizes and thread counts, and check the accuracy of the "
+                                                       "assembly against the simulated truth.")
+    sweep_parser.add_argument("--Enzyme_site", "-e", type=str, default="CTTAAG", help="Recognition site of the enzyme.")
+    sweep_parser.add_argument("--genome_sizes", "-g", type=str, default="1000000,4000000",
+                              help="Comma-separated genome sizes to simulate.")
+    sweep_parser.add_argument("--n_threads", "-c", type=str, default="1,4", help="Comma-separated thread counts.")
+    sweep_parser.add_argument("--coverage", "-x", type=float, default=10, help="Read coverage.")
+    sweep_parser.add_argument("--error_rate", type=float, default=0.0, help="Sequencing error rate of the reads.")
+    sweep_parser.add_argument("--jitter", "-j", type=float, default=200, help="Standard deviation of the labels.")
+    sweep_parser.add_argument("--seed", "-s", type=int, default=1, help="Seed for the simulated data.")
+    sweep_parser.add_argument("--main_args", type=str, default="", help="Extra arguments for main.py, e.g. "
+                                                                         "'--storage_type columnar'.")
+    sweep_parser.add_argument("--work_dir", "-w", type=str, default="benchmark_sweep",
+                              help="Directory for the simulated data and the runs.")
+    sweep_parser.add_argument("--output", "-o", type=str, default="benchmark_sweep.tsv",
+                              help="Table with the times and accuracy of each run.")
+    sweep_parser.set_defaults(func=benchmark_sweep)
+
+    args = parser.parse_args(sys.argv[1:])
+    if not hasattr(args, "func"):
+        parser.print_help()
+        sys.exit(1)
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+import hashlib
+import os
+import pickle
+
+# The index made from the input files is stored in a cache directory under a key made from the content of the input
+# files and the settings used to make it. Each run works on its own copy, because the rounds remove k-mers from it.
+# After each round the state of the run is stored in <prefix>.checkpoint.pkl, so a stopped run can continue from the
+# last finished round. The fasta contigs are kept in the cache too, uncompressed and with a faidx index, so each run
+# memory-maps them instead of reading the fasta file again.
+
+INDEX_VERSION = 3
+
+
+def hash_file(path, hasher, chunk_size=2**20):
+    """
+    Adds the content of a file to a hash
+    :param path: path to the file
+    :param hasher: hashlib object the content is added to
+    :param chunk_size: number of bytes read at once
+    :return: None
+    """
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+
+
+def get_input_key(fasta, cmap, enzyme_site, k, storage_type):
+    """
+    Makes the cache key of the index of a run
+    :param fasta: path to the fasta file
+    :param cmap: path to the cmap file
+    :param enzyme_site: recognition site of the enzyme
+    :param k: k-mer size
+    :param storage_type: sqlite or columnar
+    :return: hexadecimal sha256 of the input files and settings
+    """
+    hasher = hashlib.sha256()
+    hasher.update("{}\n{}\n{}\n{}\n".format(INDEX_VERSION, enzyme_site, k, storage_type).encode())
+    for path in [fasta, cmap]:
+        hash_file(path, hasher)
+        hasher.update(b'\n')
+    return hasher.hexdigest()
+
+
+def is_cached(cache_db_name):
+    """
+    Checks if the index of a cache key was made completely
+    :param cache_db_name: path to the index in the cache directory, without extension
+    :return: True if the index can be used
+    """
+    return os.path.exists("{}.done".format(cache_db_name))
+
+
+def mark_cached(cache_db_name):
+    """
+    Marks the index of a cache key as complete
+    :param cache_db_name: path to the index in the cache directory, without extension
+    :return: None
+    """
+    with open("{}.done".format(cache_db_name), 'w') as file:
+        file.write("done\n")
+
+
+def get_sequence_path(cache_db_name):
+    """
+    Returns the path of the uncompressed fasta file of an index, written by process_fasta.index_fasta
+    :param cache_db_name: path to the index in the cache directory, without extension
+    :return: path to the fasta file of the index
+    """
+    return "{}.fa".format(cache_db_name)
+
+
+def get_checkpoint_path(prefix):
+    """
+    Returns the path of the checkpoint file of a run
+    :param prefix: prefix of the run
+    :return: path to the checkpoint file of the run
+    """
+    return "{}.checkpoint.pkl".format(prefix)
+
+
+def save_checkpoint(prefix, settings, round_number, seq_dict, mapped_pos_per_round_dict, removed_fasta, removed_cmap):
+    """
+    Stores the state of a run after a round. The file is replaced in one step, so a run that is stopped while saving
+    keeps the checkpoint of the round before.
+    :param prefix: prefix of the run
+    :param settings: dictionary with the settings that have to be the same to continue from this checkpoint
+    :param round_number: number of rounds that are finished
+    :param seq_dict: dictionary with format {cmap_name: scaffold bytearray}
+    :param mapped_pos_per_round_dict: dictionary with format {round: number of mapped positions}
+    :param removed_fasta: list with format [[fasta_contig, position_id]] of all fasta k-mers removed so far
+    :param removed_cmap: list with format [[cmap_contig, position_id]] of all cmap k-mers removed so far
+    :return: None
+    """
+    checkpoint = {'settings': settings,
+                  'round': round_number,
+                  'seq_dict': seq_dict,
+                  'mapped_pos_per_round_dict': mapped_pos_per_round_dict,
+                  'removed_fasta': removed_fasta,
+                  'removed_cmap': removed_cmap}
+    path = get_checkpoint_path(prefix)
+    with open("{}.tmp".format(path), 'wb') as file:
+        pickle.dump(checkpoint, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace("{}.tmp".format(path), path)
+
+
+def load_checkpoint(prefix, settings):
+    """
+    Reads the checkpoint of a run if it was made with the same settings
+    :param prefix: prefix of the run
+    :param settings: dictionary with the settings of the current run
+    :return: the checkpoint dictionary stored by save_checkpoint, or None if there is no usable checkpoint
+    """
+    path = get_checkpoint_path(prefix)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as file:
+        checkpoint = pickle.load(file)
+    if checkpoint['settings'] != settings:
+        print("Ignoring checkpoint {}, it was made with other settings".format(path))
+        return None
+    return checkpoint
+
+
+def remove_checkpoint(prefix):
+    """
+    Removes the checkpoint of a finished run
+    :param prefix: prefix of the run
+    :return: None
+    """
+    path = get_checkpoint_path(prefix)
+    if os.path.exists(path):
+        os.remove(path)
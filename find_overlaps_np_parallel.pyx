@@ -1,106 +1,334 @@
 import time
-import sqlite3
 import numpy as np
 cimport numpy as np
 from joblib import Parallel, delayed
 import os
 import psutil
-cimport cython
-@cython.boundscheck(False)
-@cython.wraparound(False)
-
-def compare_1(fasta_list, cmap_array, deviation, id, contig, position_id):
-    t = time.time()
-    ranges = []
-    output_list = []
-    conditions = []
-    for j in range(3, len(fasta_list)):
-        min_val = round((fasta_list[j] - deviation), 0)
-        max_val = round((fasta_list[j] + deviation), 0)
-        conditions.append(((cmap_array[:, j-3] >= min_val) & (cmap_array[:, j-3] <= max_val)))
-
-    conditions_array = np.column_stack(conditions)
-    row_idx = np.where(np.all(conditions_array, axis = 1))[0]
-
-    for row in row_idx:
-        output_list.append([None, fasta_list[1], fasta_list[0], fasta_list[2], contig[row], id[row], position_id[row]])
-
-
-#    print('One overlap: {}'.format(time.time()-t))
-    return output_list
-
-
-def find_overlaps(db_name, deviation, n_threads):
-    print(db_name)
-    connection = sqlite3.connect("{}.db".format(db_name))
-    cursor = connection.cursor()
-    cursor.execute("""DROP TABLE IF EXISTS overlap""")
-    sqlite3.register_adapter(np.int64, int)
-    sqlite3.register_adapter(np.int32, int)
-
-    create_overlap_table = """
-    CREATE TABLE overlap (
-    id INT PRIMARY KEY,
-    fasta_contig VARCHAR(255) NOT NULL,
-    fasta_id INT NOT NULL,
-    fasta_loc INT NOT NULL,
-    cmap_contig VARCHAR(255) NOT NULL,
-    cmap_id INT NOT NULL,
-    cmap_loc INT NOT NULL
-    );
-    """
-    t = time.time()
-    cursor.execute(create_overlap_table)
-
-    GET_CMAP = """
-    SELECT * FROM cmap;
-    """
-
-    cmaps_temp = cursor.execute(GET_CMAP).fetchall()
-    id_list = np.array([v[0] for v in cmaps_temp], dtype=np.int64)
-    contig = np.array([v[1] for v in cmaps_temp])
-    position_id = np.array([v[2] for v in cmaps_temp], dtype=np.int32)
-
-    distances_dict = {}
-    cmap_np_list = []
-    for i in range(3, len(cmaps_temp[1])):
-        distances_dict["distance_{}".format(i-2)] = np.array([v[i] for v in cmaps_temp], dtype=np.int32)
-        cmap_np_list.append(distances_dict["distance_{}".format(i-2)])
-    cmap_np = tuple(cmap_np_list)
-    del(distances_dict)
-    del(cmap_np_list)
-    del(cmaps_temp)
-    
-    cmap = np.column_stack(cmap_np)
-    del(cmap_np)
-    print("hello {}".format(time.time() -t))
-    FIND_OVERLAP = """
-    SELECT * FROM fasta;
-    """
-    print("selecting all pos from FA tooks: {}".format(time.time()-t))
-    t = time.time()
-    id = 1
-    x = cursor.execute(FIND_OVERLAP)
-    y = x.fetchall()
-    del(x)
-    print(len(y))
-    pop_overlap_temp = Parallel(n_jobs=int(n_threads))(delayed(compare_1)(fasta_list, cmap, deviation, id_list, contig, position_id) for fasta_list in y)
-    print("Finding overlaps took: {}".format(time.time()-t))
-    t2 = time.time()
+import storage
+import shared_arrays as sa
+import metrics
+try:
+    import overlap_kernels
+except ImportError:
+    # overlap_kernels is only there when the extensions are built, without it the blocks are compared with NumPy
+    overlap_kernels = None
+
+
+def build_cmap_index(cmap_array):
+    """
+    Sorts the cmap distance matrix on distance_1 so the rows that fall within a deviation window of a fasta k-mer can
+    be found with a binary search instead of scanning the whole matrix
+    :param cmap_array: 2D numpy array with format [[distance_1 distance_2 ... distance_n]], 1 row per cmap k-mer
+    :return: order: numpy array with the original row index of each row in sorted_cmap
+    :return: sorted_cmap: cmap_array sorted on distance_1
+    """
+    order = np.argsort(cmap_array[:, 0], kind='stable')
+    sorted_cmap = np.ascontiguousarray(cmap_array[order])
+    return order, sorted_cmap
+
+
+def get_windows(fasta_distances, sorted_cmap, deviation):
+    """
+    Finds for each fasta k-mer the rows of sorted_cmap of which distance_1 lies within the deviation
+    :param fasta_distances: 2D numpy array with format [[distance_1 distance_2 ... distance_n]], 1 row per fasta k-mer
+    :param sorted_cmap: cmap distance matrix sorted on distance_1, as made by build_cmap_index
+    :param deviation: max deviation allowed between a fasta and a cmap distance
+    :return: lower: numpy array with the first row of the window of each fasta k-mer
+    :return: upper: numpy array with the row after the last row of the window of each fasta k-mer
+    """
+    first_distance = np.asarray(fasta_distances[:, 0], dtype=np.int64)
+    lower = np.searchsorted(sorted_cmap[:, 0], first_distance - deviation, side='left')
+    upper = np.searchsorted(sorted_cmap[:, 0], first_distance + deviation, side='right')
+    return lower, upper
+
+
+def get_blocks(n_candidates, max_candidates, max_rows):
+    """
+    Splits the fasta k-mers into blocks of consecutive rows that are each compared in 1 task
+    :param n_candidates: numpy array with the number of cmap rows in the window of each fasta k-mer
+    :param max_candidates: max number of cmap rows compared in 1 block. A fasta k-mer with a larger window gets its own
+        block.
+    :param max_rows: max number of fasta k-mers in 1 block
+    :return: list with format [(first_row, last_row + 1)]
+    """
+    blocks = []
+    cumulative = np.cumsum(n_candidates)
+    start = 0
+    while start < len(n_candidates):
+        done = cumulative[start - 1] if start > 0 else 0
+        end = int(np.searchsorted(cumulative, done + max_candidates, side='right'))
+        end = min(max(end, start + 1), start + max_rows, len(n_candidates))
+        blocks.append((start, end))
+        start = end
+    return blocks
+
+
+def get_auto_blocks(fasta_distances, sorted_cmap, deviation, n_threads, max_memory=None):
+    """
+    Chooses the blocks so that the comparison of 1 block fits in a share of the memory budget, and so that there are
+    enough blocks to keep all threads busy
+    :param fasta_distances: 2D numpy array with format [[distance_1 distance_2 ... distance_n]], 1 row per fasta k-mer
+    :param sorted_cmap: cmap distance matrix sorted on distance_1, as made by build_cmap_index
+    :param deviation: max deviation allowed between a fasta and a cmap distance
+    :param n_threads: the number of threads that can be used for computation
+    :param max_memory: memory budget in GB, or None to use the available memory
+    :return: list with format [(first_row, last_row + 1)]
+    """
+    lower, upper = get_windows(fasta_distances, sorted_cmap, deviation)
+    if max_memory is None:
+        memory = psutil.virtual_memory().available
+    else:
+        memory = max_memory * 2.**30
+    if overlap_kernels is not None:
+        # the kernel keeps 1 int64 key per hit and compares 1 block at a time, and if every compared row is a hit the
+        # overlap rows of the block take about 400 bytes per row until they are written
+        bytes_per_candidate = 24 + 400
+        budget = memory / 4
+    else:
+        # compare_block keeps about 4 int64 arrays per compared row plus 4 arrays with n_distances columns, and if
+        # every compared row is a hit the overlap rows of the block take about 400 bytes per row until they are written
+        bytes_per_candidate = 32 + 32 * sorted_cmap.shape[1] + 400
+        budget = memory / (4 * int(n_threads))
+    max_candidates = max(1, int(budget // bytes_per_candidate))
+    max_rows = max(1, -(-len(lower) // (8 * int(n_threads))))
+    return get_blocks(upper - lower, max_candidates, max_rows)
+
+
+def compare_block(start, end, fasta_distances, sorted_cmap, order, deviation, n_threads=1):
+    """
+    Finds all cmap k-mers of which every distance lies within the deviation of the distances of a block of fasta
+    k-mers. When overlap_kernels is built the rows of the block are compared by its nogil kernel on n_threads threads,
+    otherwise the windows of all fasta k-mers in the block are compared in one vectorized NumPy step. The overlaps are
+    ordered by fasta row and then by cmap row.
+    :param start: first row of the block in fasta_distances
+    :param end: row after the last row of the block in fasta_distances
+    :param fasta_distances: 2D numpy array with format [[distance_1 distance_2 ... distance_n]], 1 row per fasta k-mer
+    :param sorted_cmap: cmap distance matrix sorted on distance_1, as made by build_cmap_index
+    :param order: original row index of each row in sorted_cmap, as made by build_cmap_index
+    :param deviation: max deviation allowed between a fasta and a cmap distance
+    :param n_threads: the number of threads the kernel of overlap_kernels can use
+    :return: fasta_rows: numpy array with the fasta row of each overlap
+    :return: cmap_rows: numpy array with the cmap row of each overlap
+    :return: hit_deviation: numpy array with the largest difference between a fasta and a cmap distance of each overlap
+    """
+    if overlap_kernels is not None:
+        block = np.ascontiguousarray(fasta_distances[start:end], dtype=np.int32)
+        lower, upper = get_windows(block, sorted_cmap, deviation)
+        block_rows, cmap_rows, hit_deviation = overlap_kernels.compare_rows(
+            block, np.ascontiguousarray(sorted_cmap, dtype=np.int32), np.ascontiguousarray(order, dtype=np.int64),
+            lower.astype(np.int64), upper.astype(np.int64), int(deviation), int(n_threads))
+        return block_rows + start, cmap_rows, hit_deviation
+
+    block = np.asarray(fasta_distances[start:end], dtype=np.int64)
+    lower, upper = get_windows(block, sorted_cmap, deviation)
+    n_candidates = upper - lower
+
+    block_rows = np.repeat(np.arange(end - start), n_candidates)
+    first_candidate = np.cumsum(n_candidates) - n_candidates
+    candidates = np.arange(n_candidates.sum()) - np.repeat(first_candidate - lower, n_candidates)
+
+    hit_deviation = np.abs(sorted_cmap[candidates].astype(np.int64) - block[block_rows]).max(axis=1, initial=0)
+    hits = hit_deviation <= deviation
+
+    fasta_rows = block_rows[hits] + start
+    cmap_rows = np.asarray(order)[candidates[hits]]
+    hit_deviation = hit_deviation[hits]
+    sort_idx = np.lexsort((cmap_rows, fasta_rows))
+    return fasta_rows[sort_idx], cmap_rows[sort_idx], hit_deviation[sort_idx]
+
+
+def build_position_index(contig, position_id):
+    """
+    Makes a sorted key of the contig and position id of each k-mer, so the row of the k-mer at a position of a contig
+    can be found with a binary search
+    :param contig: numpy array with the contig/cmap name of each k-mer
+    :param position_id: numpy array with the position id of each k-mer
+    :return: tuple with format (sorted keys, row of each sorted key, key of each row, width), with the key of a k-mer
+        contig_number * width + position_id
+    """
+    names, codes = np.unique(contig, return_inverse=True)
+    # the positions start at 1 and the width leaves a free position after the last one, so moving 1 position never
+    # gives the key of a k-mer of another contig
+    width = int(position_id.max()) + 2 if len(position_id) > 0 else 1
+    keys = codes.astype(np.int64) * width + np.asarray(position_id, dtype=np.int64)
+    rows = np.argsort(keys, kind='stable')
+    return keys[rows], rows, keys, width
+
+
+def get_next_rows(position_index, rows, step):
+    """
+    Finds the rows of the k-mers step positions further on the same contig
+    :param position_index: output of build_position_index
+    :param rows: numpy array with rows of k-mers
+    :param step: number of positions to move, 1 or -1
+    :return: next_rows: numpy array with the row of each next k-mer, or the row itself if there is no next k-mer
+    :return: found: boolean numpy array that is True where the next k-mer exists and has not been removed
+    """
+    sorted_keys, key_rows, keys, width = position_index
+    next_keys = keys[rows] + step
+    idx = np.minimum(np.searchsorted(sorted_keys, next_keys), max(len(sorted_keys) - 1, 0))
+    found = sorted_keys[idx] == next_keys
+    return np.where(found, key_rows[idx], rows), found
+
+
+def extend_seed_hits(fasta_rows, cmap_rows, hit_deviation, deviation, seed_step, fasta_distances, fasta_index,
+                     sorted_cmap, cmap_rank, cmap_index):
+    """
+    Recovers the overlaps of the fasta k-mers between the seeds from the overlaps of the seeds. Consecutive overlapping
+    k-mers lie on the same diagonal, so from each seed hit the k-mers up to the next and previous seed are compared on
+    the diagonal until one does not overlap. Going back stops at the previous seed when it overlaps as well, because
+    its forward extension already has these overlaps. Every run of at least seed_step consecutive overlaps contains a
+    seed, so these runs are found completely.
+    :param fasta_rows: numpy array with the fasta row of each seed overlap
+    :param cmap_rows: numpy array with the cmap row of each seed overlap
+    :param hit_deviation: numpy array with the largest difference between a fasta and a cmap distance of each overlap
+    :param deviation: max deviation allowed between a fasta and a cmap distance
+    :param seed_step: distance in positions between 2 seeds of a fasta contig
+    :param fasta_distances: 2D numpy array with format [[distance_1 distance_2 ... distance_n]], 1 row per fasta k-mer
+    :param fasta_index: output of build_position_index for the fasta k-mers
+    :param sorted_cmap: cmap distance matrix sorted on distance_1, as made by build_cmap_index
+    :param cmap_rank: row in sorted_cmap of each cmap row
+    :param cmap_index: output of build_position_index for the cmap k-mers
+    :return: fasta_rows: numpy array with the fasta row of each overlap
+    :return: cmap_rows: numpy array with the cmap row of each overlap
+    :return: hit_deviation: numpy array with the largest difference between a fasta and a cmap distance of each overlap
+    The overlaps are ordered by fasta row and then by cmap row.
+    """
+    found_fasta = [fasta_rows]
+    found_cmap = [cmap_rows]
+    found_deviation = [hit_deviation]
+    for direction in (1, -1):
+        seed = np.arange(len(fasta_rows))
+        current_fasta = fasta_rows
+        current_cmap = cmap_rows
+        extension = []
+        # going back also compares the previous seed, to know if its forward extension has the overlaps
+        n_steps = seed_step if direction == -1 else seed_step - 1
+        for step in range(n_steps):
+            next_fasta, fasta_found = get_next_rows(fasta_index, current_fasta, direction)
+            next_cmap, cmap_found = get_next_rows(cmap_index, current_cmap, direction)
+            step_deviation = np.abs(sorted_cmap[cmap_rank[next_cmap]].astype(np.int64) -
+                                    fasta_distances[next_fasta]).max(axis=1, initial=0)
+            hits = fasta_found & cmap_found & (step_deviation <= deviation)
+            seed = seed[hits]
+            current_fasta = next_fasta[hits]
+            current_cmap = next_cmap[hits]
+            if step < seed_step - 1:
+                extension.append((seed, current_fasta, current_cmap, step_deviation[hits]))
+        for seed_hits, extension_fasta, extension_cmap, extension_deviation in extension:
+            # the seeds that reached the next seed in this direction are what is left after the last step
+            keep = ~np.isin(seed_hits, seed) if direction == -1 else np.ones(len(seed_hits), dtype=bool)
+            found_fasta.append(extension_fasta[keep])
+            found_cmap.append(extension_cmap[keep])
+            found_deviation.append(extension_deviation[keep])
+
+    fasta_rows = np.concatenate(found_fasta)
+    cmap_rows = np.concatenate(found_cmap)
+    hit_deviation = np.concatenate(found_deviation)
+    sort_idx = np.lexsort((cmap_rows, fasta_rows))
+    return fasta_rows[sort_idx], cmap_rows[sort_idx], hit_deviation[sort_idx]
+
+
+def get_overlap_batches(block_results, fasta_contig, fasta_id, fasta_position_id, contig, id_list, position_id):
+    """
+    Turns the hits of each block into rows of the overlap table as the blocks are done, so only the rows of 1 block
+    are in memory at a time
+    :param block_results: iterable with the output of compare_block for each block, in order
+    :param fasta_contig: numpy array with the fasta name of each fasta k-mer
+    :param fasta_id: numpy array with the id of each fasta k-mer
+    :param fasta_position_id: numpy array with the position id of each fasta k-mer
+    :param contig: numpy array with the cmap name of each cmap k-mer
+    :param id_list: numpy array with the id of each cmap k-mer
+    :param position_id: numpy array with the position id of each cmap k-mer
+    :return: generator of lists with format [[id, fasta_contig, fasta_id, fasta_loc, cmap_contig, cmap_id, cmap_loc,
+        deviation]], 1 list per block
+    """
     id = 1
-    pop_overlap = []
-    for item in pop_overlap_temp:
-        for item2 in item:
-            item2[0] = id
+    for fasta_rows, cmap_rows, hit_deviation in block_results:
+        batch = []
+        for row in zip(fasta_contig[fasta_rows].tolist(), fasta_id[fasta_rows].tolist(),
+                       fasta_position_id[fasta_rows].tolist(), contig[cmap_rows].tolist(),
+                       id_list[cmap_rows].tolist(), position_id[cmap_rows].tolist(), hit_deviation.tolist()):
+            batch.append([id, *row])
             id += 1
-            pop_overlap.append(item2)
-    pid = os.getpid()
-    python_process = psutil.Process(pid)
-    memoryUse = python_process.memory_info()[0]/2.**30  # memory use in GB...I think
-    print(psutil.virtual_memory())
-    print('memory use: {}'.format(memoryUse))
-    cursor.executemany('INSERT INTO overlap VALUES (?,?,?,?,?,?,?)', pop_overlap)
-    connection.commit()
-    print("Inserting overlaps took: {}".format(time.time()-t2))	
-    print("finding all overlaps took: {}.\nFound {} overlaps".format(time.time()-t,len(pop_overlap)))
+        yield batch
+
+
+def find_overlaps(db_name, deviation, n_threads, storage_type='sqlite', block_size=0, max_memory=None,
+                  fasta_contigs=None, seed_step=1):
+    with metrics.stage('find_overlaps', deviation=deviation, workers=int(n_threads),
+                       storage_type=storage_type, seed_step=seed_step) as record:
+        print(db_name)
+        backend = storage.get_backend(storage_type)
+        t = time.time()
 
+        id_list, contig, position_id, cmap = backend.read_kmers(db_name, 'cmap')
+        order, sorted_cmap = build_cmap_index(cmap)
+        del(cmap)
+        if seed_step > 1:
+            cmap_index = build_position_index(contig, position_id)
+            cmap_rank = np.empty(len(order), dtype=np.int64)
+            cmap_rank[order] = np.arange(len(order))
+        print("hello {}".format(time.time() -t))
+        print("selecting all pos from FA tooks: {}".format(time.time()-t))
+        t = time.time()
+        fasta_id, fasta_contig, fasta_position_id, fasta_distances = backend.read_kmers(db_name, 'fasta')
+        if fasta_contigs is not None:
+            # A shard only searches the overlaps of its own fasta contigs
+            keep = np.isin(fasta_contig, list(fasta_contigs))
+            fasta_id = fasta_id[keep]
+            fasta_contig = fasta_contig[keep]
+            fasta_position_id = fasta_position_id[keep]
+            fasta_distances = fasta_distances[keep]
+        if seed_step > 1:
+            # Only every seed_step-th k-mer of each fasta contig is compared to the cmap k-mers, the other overlaps
+            # are found by extend_seed_hits
+            seeds = np.nonzero((fasta_position_id - 1) % seed_step == 0)[0]
+            fasta_index = build_position_index(fasta_contig, fasta_position_id)
+            query_distances = fasta_distances[seeds]
+        else:
+            query_distances = fasta_distances
+        print(len(fasta_id))
+        if block_size > 0:
+            blocks = get_blocks(np.zeros(len(query_distances), dtype=np.int64), 1, block_size)
+        else:
+            blocks = get_auto_blocks(query_distances, sorted_cmap, deviation, n_threads, max_memory)
+        print("Comparing {} blocks".format(len(blocks)))
+        shared_dir = None
+        try:
+            if overlap_kernels is not None:
+                # The kernel compares the rows of a block on all threads, so the blocks are compared one after the
+                # other in this process and the overlaps of each block are written before the next block is compared
+                block_results = (compare_block(start, end, query_distances, sorted_cmap, order, deviation, n_threads)
+                                 for start, end in blocks)
+            else:
+                # The arrays are the same for every block, so they are memory-mapped once instead of sent with each
+                # task
+                shared_dir = sa.make_shared_dir(db_name)
+                sorted_cmap = sa.share_array(shared_dir, 'sorted_cmap', sorted_cmap)
+                order = sa.share_array(shared_dir, 'order', order)
+                query_distances = sa.share_array(shared_dir, 'fasta_distances', query_distances)
+                # The blocks are compared while the overlaps of finished blocks are written, and at most 2 blocks per
+                # thread wait to be written
+                block_results = Parallel(n_jobs=int(n_threads), return_as='generator', pre_dispatch='2*n_jobs')(
+                    delayed(compare_block)(start, end, query_distances, sorted_cmap, order, deviation)
+                    for start, end in blocks)
+            if seed_step > 1:
+                block_results = (extend_seed_hits(seeds[seed_rows], cmap_rows, hit_deviation, deviation, seed_step,
+                                                  fasta_distances, fasta_index, sorted_cmap, cmap_rank, cmap_index)
+                                 for seed_rows, cmap_rows, hit_deviation in block_results)
+            overlap_batches = get_overlap_batches(block_results, fasta_contig, fasta_id, fasta_position_id, contig,
+                                                  id_list, position_id)
+            n_overlaps = backend.write_overlaps(db_name, overlap_batches)
+        finally:
+            if shared_dir is not None:
+                sa.remove_shared_dir(shared_dir)
+        pid = os.getpid()
+        python_process = psutil.Process(pid)
+        memoryUse = python_process.memory_info()[0]/2.**30  # memory use in GB...I think
+        print(psutil.virtual_memory())
+        print('memory use: {}'.format(memoryUse))
+        print("finding all overlaps took: {}.\nFound {} overlaps".format(time.time()-t, n_overlaps))
+        record.update({'cmap_rows': len(id_list), 'fasta_rows': len(fasta_id), 'blocks': len(blocks),
+                       'queried_rows': len(query_distances), 'hits': n_overlaps,
+                       'kernels': overlap_kernels is not None})
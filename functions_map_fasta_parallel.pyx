@@ -1,61 +1,58 @@
 import time
-import sqlite3
 import numpy as np
 cimport numpy as np
 from joblib import Parallel, delayed
 import os
 import psutil
-cimport cython
-@cython.boundscheck(False)
-@cython.wraparound(False)
+import storage
 
-def get_positions(table_type, cursor):
+
+def get_positions(table_type, db_name, storage_type):
     """
-    Extract position ids and enzyme sites from sql table and store into memory as np
+    Extract position ids and enzyme sites from storage and store into memory as np
     arrays
     :param table_type: fasta or cmap
-    :param cursor: connection to database
+    :param db_name: name of the database
+    :param storage_type: sqlite or columnar
     :return: np_positions: 2D numpy array with format [[pos_1 pos_2 ... pos_n]]
-    :return: np_name_id: 2D numpy array with format [[contig/cmap_name position_id]]
+    :return: position_index: dictionary with format {contig/cmap_name:row of position_id 1 in np_positions}
     """
-    cmd = """
-        SELECT * FROM {}_contigs;
-        """.format(table_type)
-
-    tmp_pos = cursor.execute(cmd).fetchall()
-
-    contig_array = np.array([v[1] for v in tmp_pos])
-    pos_id_array = np.array([v[2] for v in tmp_pos], dtype=np.int32)
-
-    pos_dict = {}
-    pos_np_list = []
-    for i in range(3, len(tmp_pos[1])):
-        pos_dict["position_{}".format(i - 2)] = np.array([v[i] for v in tmp_pos], dtype=np.int32)
-        pos_np_list.append(pos_dict["position_{}".format(i - 2)])
-    pos_np = tuple(pos_np_list)
-    np_positions = np.column_stack(pos_np)
-    np_name_id = np.column_stack((contig_array,pos_id_array))
+    backend = storage.get_backend(storage_type)
+    np_positions, contig_array, pos_id_array = backend.read_positions(db_name, table_type)
+    position_index = get_position_index(contig_array, pos_id_array)
     del pos_id_array
     del contig_array
-    del pos_np
-    del pos_dict
-    del tmp_pos
-    del pos_np_list
 
-    return np_positions, np_name_id
+    return np_positions, position_index
+
+
+def get_position_index(contig_array, pos_id_array):
+    """
+    Makes the index used to look up the row of a k-mer in np_positions. The rows of each contig/cmap are stored
+    together and ordered by position_id, so the row of any position_id follows from the row of position_id 1.
+    :param contig_array: numpy array with the contig/cmap name of each row
+    :param pos_id_array: numpy array with the position_id of each row
+    :return: dictionary with format {contig/cmap_name:row of position_id 1}
+    """
+    contig_names, first_rows = np.unique(contig_array, return_index=True)
+    first_rows = first_rows - np.asarray(pos_id_array)[first_rows] + 1
+    return dict(zip(contig_names.tolist(), first_rows.tolist()))
 
 
-def get_cmap_pos_dict(cmap_list, cursor):
+def get_cmap_pos_dict(cmap_list, db_name, storage_type):
     """
     Function to obtain a dictionary that contains a key for each cmap, with as value a list of all the position_ids in
-    that cmap
+    that cmap that have not been removed
     :param cmap_list: list of all cmap names
-    :param cursor: Connection to the database
+    :param db_name: name of the database
+    :param storage_type: sqlite or columnar
     :return: {cmap_name:[position_ids]}
     """
+    backend = storage.get_backend(storage_type)
+    contig_positions = backend.get_contig_positions(db_name, 'cmap')
     cmap_pos_dict = {}
     for cmap in cmap_list:
-        cmap_pos_dict[cmap] = get_all_positions_in_cmap(cmap, cursor)
+        cmap_pos_dict[cmap] = contig_positions.get(cmap, [])
 
     return cmap_pos_dict
 
@@ -77,42 +74,36 @@ def get_empty_cmap_dict(cmap_temp):
     return cmap_dict, sorted_cmap_pos
 
 
-def get_overlapping_fasta(fasta_contig, db_name):
+def get_overlapping_fasta(fasta_contig, db_name, storage_type, max_deviation=None):
     """
-    Function to extract the overlaps of 1 fasta location to all cmaps from the overlap sql table
+    Function to extract the overlaps of 1 fasta location to all cmaps from the stored overlaps
     :param fasta_contig: name of the fasta contig of which overlapping sequences will be extracted
-    :param db_name: name of the sql database
-    :return: set containing the overlap information in the format((fasta_loc, cmap_loc, cmap_contig))
+    :param db_name: name of the database
+    :param storage_type: sqlite or columnar
+    :param max_deviation: if given, only use the overlaps with at most this deviation of which neither k-mer has been
+        removed. Used when the overlaps of all rounds were found at once.
+    :return: numpy arrays with the fasta_loc, cmap_loc and cmap_contig of each overlap
     """
-    connection = sqlite3.connect("{}.db".format(db_name))
-    cursor = connection.cursor()
-    cmd = """SELECT fasta_loc, cmap_loc, cmap_contig FROM overlap
-        WHERE fasta_contig=\"{}\"
-        ORDER BY fasta_loc;""".format(fasta_contig)
-
-    mapped_positions_temp = set(cursor.execute(cmd).fetchall())
-    return mapped_positions_temp
+    backend = storage.get_backend(storage_type)
+    fasta_loc, cmap_loc, cmap_contig = backend.read_overlaps(db_name, fasta_contig, max_deviation)
+    return fasta_loc, cmap_loc, cmap_contig
 
 
-def change_format_overlap_fasta(mapped_positions_temp):
+def change_format_overlap_fasta(fasta_loc, cmap_loc, cmap_contig):
     """
-    This funcion changes the output of get_overlapping_fasta to a dictionary.
-    :param mapped_positions_temp: output of get_overlapping_fasta
-    :return: dictionary containing the overlap information of each fasta in the format:
-     {fasta_loc:("<cmap_loc>,<cmap_contig>")}
+    This funcion changes the output of get_overlapping_fasta to integer arrays by giving each cmap a number.
+    :param fasta_loc: numpy array with the fasta position id of each overlap
+    :param cmap_loc: numpy array with the cmap position id of each overlap
+    :param cmap_contig: numpy array with the cmap name of each overlap
+    :return: fasta_pos: numpy int64 array with the fasta position id of each overlap
+    :return: cmap_idx: numpy int64 array with the number of the cmap of each overlap
+    :return: cmap_pos: numpy int64 array with the cmap position id of each overlap
+    :return: cmap_names: numpy array with the name of each cmap number
     """
-    mapped_positions = {}
-
-    for mapping_pos in mapped_positions_temp:
-        mapped_positions[mapping_pos[0]] = []
-
-    for mapping_pos in mapped_positions_temp:
-        mapped_positions[mapping_pos[0]].append("{},{}".format(mapping_pos[1], mapping_pos[2]))
-
-    for fasta_loc in mapped_positions:
-        mapped_positions[fasta_loc] = set(mapped_positions[fasta_loc])
-
-    return mapped_positions
+    cmap_names, cmap_idx = np.unique(cmap_contig, return_inverse=True)
+    fasta_pos = np.asarray(fasta_loc, dtype=np.int64)
+    cmap_pos = np.asarray(cmap_loc, dtype=np.int64)
+    return fasta_pos, cmap_idx.astype(np.int64).reshape(-1), cmap_pos, cmap_names
 
 
 def sort_overlap_output_lists(fasta_locations_list, cmap_locations_list, names_length_list):
@@ -134,11 +125,16 @@ def sort_overlap_output_lists(fasta_locations_list, cmap_locations_list, names_l
     return sorted_data
 
 
-def get_consecutive_overlapping_kmers(mapped_positions, min_kmer_consecutive, fasta_contig):
+def get_consecutive_overlapping_kmers(fasta_pos, cmap_idx, cmap_pos, cmap_names, min_kmer_consecutive, fasta_contig):
     """
-    Function that extracts consecutive overlapping k-mers from the overlap dictionary created in
-    change_format_overlap_fasta
-    :param mapped_positions: Output of change_format_overlap_fasta
+    Function that extracts consecutive overlapping k-mers from the overlap arrays created in
+    change_format_overlap_fasta. Consecutive overlapping k-mers lie on the same diagonal (fasta_pos - cmap_pos) of the
+    same cmap, so the overlaps are sorted by cmap, diagonal and fasta_pos and each run of fasta_pos that goes up by 1
+    is one consecutive overlap.
+    :param fasta_pos: numpy array with the fasta position id of each overlap
+    :param cmap_idx: numpy array with the number of the cmap of each overlap
+    :param cmap_pos: numpy array with the cmap position id of each overlap
+    :param cmap_names: numpy array with the name of each cmap number
     :param min_kmer_consecutive: The minimum number of consecutive overlapping k-mers for an overlap to be considered
     :param fasta_contig: The fasta contig of which the overlaps are examined
     :return: final_fasta_loc: list that contains a list for each consecutive overlap, the list contains each position_id
@@ -151,85 +147,78 @@ def get_consecutive_overlapping_kmers(mapped_positions, min_kmer_consecutive, fa
     final_fasta_loc = []
     final_cmap_loc = []
     final_names_overlap_len = []
-    skip_dict = {}
-
-    for fa_pos in mapped_positions:
-        for overlap_cmaps in mapped_positions[fa_pos]:
-            content = overlap_cmaps.split(',')
-            cmap_loc = int(content[0])
-            cmap_name = content[1]
-            k = "{},{},{}".format(fa_pos, cmap_loc, cmap_name)
-            if skip_dict.get(k) != None:
-                continue
-            skip_dict["{},{},{}".format(fa_pos, cmap_loc, cmap_name)] = 1
-            temp_fasta_loc = [int(fa_pos)]
-            temp_cmap_loc = [cmap_loc]
-            temp_names_overlap_len = [fasta_contig, cmap_name, 0]
-
-            temp_fasta_loc.append(fa_pos)
-            temp_cmap_loc.append(cmap_loc)
-            nx = "{},{}".format(temp_cmap_loc[-1] + 1, cmap_name)
-            while temp_fasta_loc[-1] + 1 in mapped_positions and nx in mapped_positions[temp_fasta_loc[-1] + 1]:
-                temp_fasta_loc.append(temp_fasta_loc[-1] + 1)
-                temp_cmap_loc.append(temp_cmap_loc[-1] + 1)
-                nx = "{},{}".format(temp_cmap_loc[-1] + 1, cmap_name)
-                skip_dict["{},{},{}".format(temp_fasta_loc[-1] + 1, temp_cmap_loc[-1] + 1, cmap_name)] = 1
-                temp_names_overlap_len[2] += 1
-            if temp_fasta_loc[-1] + 1 not in mapped_positions or nx not in mapped_positions[temp_fasta_loc[-1] + 1]:
-                if temp_names_overlap_len[2] >= min_kmer_consecutive:
-                    final_fasta_loc.append(temp_fasta_loc)
-                    final_cmap_loc.append(temp_cmap_loc)
-                    final_names_overlap_len.append(temp_names_overlap_len)
+
+    diagonal = fasta_pos - cmap_pos
+    order = np.lexsort((fasta_pos, diagonal, cmap_idx))
+    fasta_pos = fasta_pos[order]
+    cmap_pos = cmap_pos[order]
+    cmap_idx = cmap_idx[order]
+    diagonal = diagonal[order]
+
+    new_run = np.ones(len(fasta_pos), dtype=bool)
+    new_run[1:] = ((cmap_idx[1:] != cmap_idx[:-1]) | (diagonal[1:] != diagonal[:-1]) |
+                   (fasta_pos[1:] != fasta_pos[:-1] + 1))
+    starts = np.nonzero(new_run)[0]
+    lengths = np.diff(np.append(starts, len(fasta_pos)))
+    # the overlap length counts the steps from one k-mer to the next
+    keep = lengths - 1 >= min_kmer_consecutive
+
+    for start, length in zip(starts[keep].tolist(), lengths[keep].tolist()):
+        final_fasta_loc.append(list(range(int(fasta_pos[start]), int(fasta_pos[start]) + length)))
+        final_cmap_loc.append(list(range(int(cmap_pos[start]), int(cmap_pos[start]) + length)))
+        final_names_overlap_len.append([fasta_contig, str(cmap_names[cmap_idx[start]]), length - 1])
     return final_fasta_loc, final_cmap_loc, final_names_overlap_len
 
 
 def get_idx_overlapping_fasta_locations(sorted_data):
     """
-    Function that obtains the indexes of overlaps in the sorted data list that have overlapping fasta locations
-    :param sorted_data:
-    :return:
+    Function that obtains the indexes of overlaps in the sorted data list that have overlapping fasta locations with a
+    longer overlap that is kept. Going from the longest to the shortest overlap, the fasta locations of each kept
+    overlap are marked in an occupancy bitmap, and an overlap that uses an occupied location is not kept.
+    :param sorted_data: output of sort_overlap_output_lists
+    :return: set with the indexes of the overlaps that should be removed
     """
     delete_list = set([])
+    if len(sorted_data) == 0:
+        return delete_list
 
+    occupied = np.zeros(max(max(data[1]) for data in sorted_data) + 1, dtype=bool)
     for i in range(len(sorted_data)):
-        if i in delete_list:
-            continue
-        for j in range(len(sorted_data)):
-            if (j in delete_list) or (i >= j):
-                continue
-            elif any(np.isin(sorted_data[i][1], sorted_data[j][1])):
-                delete_list.add(j)
+        fasta_locations = sorted_data[i][1]
+        if occupied[fasta_locations].any():
+            delete_list.add(i)
+        else:
+            occupied[fasta_locations] = True
     return delete_list
 
 
-
-def get_pos_from_loc(contig_name, loc, np_positions, np_name_id):
+def get_pos_from_loc(contig_name, loc, np_positions, position_index):
     """
     Takes the position id and contig name and returns the actual location on the cmap/sequence
     :param contig_name: name of the contig
     :param loc: position_id
     :param np_positions: numpy array with format [[pos_1 pos_2 pos_3 ... pos_n]]. The array has 1 row per k-mer
-    :param np_name_id: numpy array with format [[name position_id]] with a row per cmap/fasta and position_id
+    :param position_index: dictionary with format {name:row of position_id 1 in np_positions}
     :return: list of positions with format ["start:end", "start:end"] for each pair of enzyme sites with the position id
     """
-    conditions = (np_name_id[:,0] == contig_name) & (np_name_id[:,1] == str(loc))
-    row_idx = np.where(conditions)[0]
+    row = position_index[contig_name] + int(loc) - 1
     positions = []
     for i in range(np_positions.shape[1]-1):
-        positions.append("{},{}".format(np_positions[row_idx,i][0], np_positions[row_idx, i + 1][0]))
+        positions.append("{},{}".format(np_positions[row, i], np_positions[row, i + 1]))
     return positions
 
 
-def change_output_format(sorted_data, np_positions_cmap, np_name_id_cmap, np_positions_fasta, np_name_id_fasta):
+def change_output_format(sorted_data, np_positions_cmap, position_index_cmap, np_positions_fasta,
+                         position_index_fasta):
     """
     Changes the format of the consecutive overlap from 3 lists to a dictionary
     :param sorted_data: list of lists that contains the filtered consecutive overlap information
     :param np_positions_cmap: numpy array with format [[pos_1 pos_2 pos_3 ... pos_n]]. The array has 1 row per k-mer
         per cmap
-    :param np_name_id_cmap: numpy array with format [[cmap_name position_id]] with a row per cmap and position_id
+    :param position_index_cmap: dictionary with format {cmap_name:row of position_id 1 in np_positions_cmap}
     :param np_positions_fasta: numpy array with format [[pos_1 pos_2 pos_3 ... pos_n]]. The array has 1 row per k-mer
         per fasta
-    :param np_name_id_fasta: numpy array with format [[fasta_name position_id]] with a row per fasta and position_id
+    :param position_index_fasta: dictionary with format {fasta_name:row of position_id 1 in np_positions_fasta}
     :return: final_output: dictionary with format {cmap_name:{"cmap_star:cmap_end":["fasta_start:fasta_end", contig]}}
     :return: remove_fasta: List of fasta position ids that have been mapped and should be removed before further
     alignment rounds
@@ -250,12 +239,15 @@ def change_output_format(sorted_data, np_positions_cmap, np_name_id_cmap, np_pos
             remove_fasta.append([fasta_name,sorted_data[i][1][j]])
             remove_cmap.append([cmap_name,sorted_data[i][2][j]])
             if j == 0:
-                cmap_pos += get_pos_from_loc(cmap_name, sorted_data[i][2][j], np_positions_cmap, np_name_id_cmap)
-                fasta_pos += get_pos_from_loc(fasta_name, sorted_data[i][1][j], np_positions_fasta, np_name_id_fasta)
+                cmap_pos += get_pos_from_loc(cmap_name, sorted_data[i][2][j], np_positions_cmap, position_index_cmap)
+                fasta_pos += get_pos_from_loc(fasta_name, sorted_data[i][1][j], np_positions_fasta,
+                                              position_index_fasta)
 
             else:
-                cmap_pos.append(get_pos_from_loc(cmap_name, sorted_data[i][2][j], np_positions_cmap, np_name_id_cmap)[-1])
-                fasta_pos.append(get_pos_from_loc(fasta_name, sorted_data[i][1][j], np_positions_fasta, np_name_id_fasta)[-1])
+                cmap_pos.append(get_pos_from_loc(cmap_name, sorted_data[i][2][j], np_positions_cmap,
+                                                 position_index_cmap)[-1])
+                fasta_pos.append(get_pos_from_loc(fasta_name, sorted_data[i][1][j], np_positions_fasta,
+                                                  position_index_fasta)[-1])
         t = time.time()
         if final_output.get(cmap_name) == None:
             final_output[cmap_name] = {}
@@ -268,8 +260,8 @@ def change_output_format(sorted_data, np_positions_cmap, np_name_id_cmap, np_pos
     return final_output, remove_fasta, remove_cmap
 
 
-def get_mapping_location_fasta(fasta_contig, min_kmer_consecutive, db_name, np_positions_cmap, np_name_id_cmap,
-                               np_positions_fasta, np_name_id_fasta):
+def get_mapping_location_fasta(fasta_contig, min_kmer_consecutive, db_name, np_positions_cmap, position_index_cmap,
+                               np_positions_fasta, position_index_fasta, storage_type, max_deviation=None):
     """
     Function to obtain all the locations where a fasta contig overlaps with any cmap. The function then filters these
     and returns the filtered output.
@@ -278,19 +270,23 @@ def get_mapping_location_fasta(fasta_contig, min_kmer_consecutive, db_name, np_p
     :param db_name: name of the database
     :param np_positions_cmap: numpy array with format [[pos_1 pos_2 pos_3 ... pos_n]]. The array has 1 row per k-mer
         per cmap
-    :param np_name_id_cmap: numpy array with format [[cmap_name position_id]] with a row per cmap and position_id
+    :param position_index_cmap: dictionary with format {cmap_name:row of position_id 1 in np_positions_cmap}
     :param np_positions_fasta: numpy array with format [[pos_1 pos_2 pos_3 ... pos_n]]. The array has 1 row per k-mer
         per fasta
-    :param np_name_id_fasta: numpy array with format [[fasta_name position_id]] with a row per fasta and position_id
+    :param position_index_fasta: dictionary with format {fasta_name:row of position_id 1 in np_positions_fasta}
+    :param storage_type: sqlite or columnar
+    :param max_deviation: if given, only use the overlaps with at most this deviation of which neither k-mer has been
+        removed
     :return: list with format [{cmap_name:{"cmap_start:cmap_stop":["fasta_start:fasta_stop", fasta_name]}},
     remove_fasta, remove_cmap]
     """
     t = time.time()
-    mapped_pos_temp = get_overlapping_fasta(fasta_contig, db_name)
-    mapped_positions = change_format_overlap_fasta(mapped_pos_temp)
-    del mapped_pos_temp
-    
-    final_fasta_loc, final_cmap_loc, final_names_overlap_len = get_consecutive_overlapping_kmers(mapped_positions,
+    fasta_loc, cmap_loc, cmap_contig = get_overlapping_fasta(fasta_contig, db_name, storage_type, max_deviation)
+    fasta_pos, cmap_idx, cmap_pos, cmap_names = change_format_overlap_fasta(fasta_loc, cmap_loc, cmap_contig)
+    del fasta_loc, cmap_loc, cmap_contig
+
+    final_fasta_loc, final_cmap_loc, final_names_overlap_len = get_consecutive_overlapping_kmers(fasta_pos, cmap_idx,
+                                                                                                 cmap_pos, cmap_names,
                                                                                                  min_kmer_consecutive,
                                                                                                  fasta_contig)
 
@@ -307,20 +303,20 @@ def get_mapping_location_fasta(fasta_contig, min_kmer_consecutive, db_name, np_p
 
     final_output, remove_fasta, remove_cmap = change_output_format(sorted_data,
                                                                    np_positions_cmap,
-                                                                   np_name_id_cmap,
+                                                                   position_index_cmap,
                                                                    np_positions_fasta,
-                                                                   np_name_id_fasta)
+                                                                   position_index_fasta)
     return [final_output, remove_fasta, remove_cmap]
 
 
-def init_cmap_dict(cmap_name, np_positions_cmap, np_name_id_cmap, positions):
+def init_cmap_dict(cmap_name, np_positions_cmap, position_index_cmap, positions):
     """
     Function that initializes a dictionary, each interval between two enzyme sites is a key. The format is:
     {"cmap_start:cmap_end":False}. The function also creates a list with the ordered positions.
     :param cmap_name: Name of the cmap
     :param np_positions_cmap: numpy array with format [[pos_1 pos_2 pos_3 ... pos_n]]. The array has 1 row per k-mer
         per cmap
-    :param np_name_id_cmap: numpy array with format [[cmap_name position_id]] with a row per cmap and position_id
+    :param position_index_cmap: dictionary with format {cmap_name:row of position_id 1 in np_positions_cmap}
     :param positions: list of all position_ids in the cmap
     :return: a list with format [cmap_name, {cmap_location:False}, [sorted_locations]]
     """
@@ -329,41 +325,20 @@ def init_cmap_dict(cmap_name, np_positions_cmap, np_name_id_cmap, positions):
     mapped_cmap[cmap_name] = {}
     for i in range(len(positions)):
         if i == 0:
-            sorted_pos += get_pos_from_loc(cmap_name, positions[i], np_positions_cmap, np_name_id_cmap)
-            cmap_pos = get_pos_from_loc(cmap_name, positions[i], np_positions_cmap, np_name_id_cmap)
+            sorted_pos += get_pos_from_loc(cmap_name, positions[i], np_positions_cmap, position_index_cmap)
+            cmap_pos = get_pos_from_loc(cmap_name, positions[i], np_positions_cmap, position_index_cmap)
             for j in range(len(cmap_pos)):
                 mapped_cmap[cmap_pos[j]] = False
         else:
-            cmap_pos = get_pos_from_loc(cmap_name, positions[i], np_positions_cmap, np_name_id_cmap)[-1]
+            cmap_pos = get_pos_from_loc(cmap_name, positions[i], np_positions_cmap, position_index_cmap)[-1]
             sorted_pos.append(cmap_pos)
             mapped_cmap[cmap_pos] = False
     return [cmap_name, mapped_cmap, sorted_pos]
 
 
-def get_all_positions_in_cmap(cmap, cursor):
-    cmap_positions = []
-    cmd = """SELECT pos_contig FROM cmap
-            WHERE contig=\"{}\"
-            ORDER BY pos_contig ASC;""".format(cmap)
-
-    cmap_positions_temp = cursor.execute(cmd).fetchall()
-    for pos in cmap_positions_temp:
-        cmap_positions.append(pos[0])
-
-    return cmap_positions
-
-
-def get_cmap_list(db_name):
-    connection = sqlite3.connect("{}.db".format(db_name))
-    print("{}.db".format(db_name))
-    cursor = connection.cursor()
-    cmap_list = []
-    get_cmaps = """
-        SELECT contig FROM cmap_contigs;"""
-    cmap_list_cmd = cursor.execute(get_cmaps)
-    for item in cmap_list_cmd.fetchall():
-        if item[0] not in cmap_list:
-            cmap_list.append(item[0])
+def get_cmap_list(db_name, storage_type):
+    backend = storage.get_backend(storage_type)
+    cmap_list = backend.get_contig_list(db_name, 'cmap')
     return cmap_list
 
 
@@ -394,27 +369,40 @@ def enter_info_cmap_dict(mapped_fasta_temp, cmap_dict):
 
 
 def merge_fa_cmap(mapped_cmaps, cmap, sorted_pos, enzyme_sequence, fasta_sequence_dict, sequence):
+    """
+    Builds the scaffold of 1 cmap, or patches the scaffold of an earlier round with the newly mapped fasta sequences.
+    The scaffold is a bytearray, so the N-fills are added in bulk and mapped intervals are replaced in place.
+    :param mapped_cmaps: {cmap:{"cmap_start,cmap_end":["fasta_start,fasta_end", fasta_contig, overlap_len]}}
+    :param cmap: name of the cmap
+    :param sorted_pos: list with the "cmap_start,cmap_end" keys of the cmap in order
+    :param enzyme_sequence: String that contains the DNA sequence recognised by the Enzyme used in cmap creation.
+    :param fasta_sequence_dict: Dictionary with format {'contig name' : 'sequence information'}
+    :param sequence: bytearray with the scaffold of the earlier rounds, empty in the first round
+    :return: [cmap, scaffold bytearray, number of mapped positions]
+    """
     mapped_pos_number = 0
-    if sequence == '':
+    enzyme_bytes = enzyme_sequence.encode()
+    if len(sequence) == 0:
         for position in sorted_pos:
             if not mapped_cmaps[cmap][position]:
                 content = position.split(",")
                 n_count = int(content[1]) - int(content[0])-len(enzyme_sequence)
-                sequence += enzyme_sequence
-                for i in range(n_count):
-                    sequence += 'N'
+                sequence += enzyme_bytes
+                sequence += b'N' * max(n_count, 0)
             else:
                 content = mapped_cmaps[cmap][position][0].split(",")
                 seq = fasta_sequence_dict[mapped_cmaps[cmap][position][1]][int(content[0]):int(content[1])]
-                sequence += seq
+                sequence += seq.encode()
                 mapped_pos_number += 1
     else:
-        #change so that the seq is a list that is changed
-        for position in sorted_pos[cmap]:
+        for position in sorted_pos:
             if mapped_cmaps[cmap][position] != False:
                 content = mapped_cmaps[cmap][position][0].split(",")
                 seq = fasta_sequence_dict[mapped_cmaps[cmap][position][1]][int(content[0]):int(content[1])]
                 pos = position.split(',')
-                sequence = sequence[0:int(pos[0])] + seq + sequence[int(pos[1])::]
+                start, end = int(pos[0]), int(pos[1])
+                # when end < start the string splice sequence[0:start] + seq + sequence[end:] kept sequence[end:start]
+                # twice, so it is put back after seq
+                sequence[start:max(start, end)] = seq.encode() + sequence[end:start]
                 mapped_pos_number += 1
     return [cmap, sequence, mapped_pos_number]
@@ -1,73 +1,343 @@
-import sqlite3
 from multiprocessing import Process
 import argparse
+import os
 import time
 import sys
+import metrics
 
-def cmap2sql(cmap, db_name, k):
+def cmap2sql(cmap, db_name, k, storage_type):
     import process_cmap as pc
     import make_sql
+    import storage
+    backend = storage.get_backend(storage_type)
     positions_cmap, contig_length = pc.get_positions(cmap)
     print(len(positions_cmap))
-    pc.make_length_table(contig_length, db_name)
+    backend.write_lengths(db_name, contig_length)
     distances_cmap,distance_list_cmap = make_sql.get_distance(positions_cmap)
-    make_sql.make_db(distances_cmap, db_name, k, positions_cmap, 'cmap')
+    with metrics.stage('make_db', table='cmap', storage_type=storage_type) as record:
+        record['rows'] = backend.write_kmers(db_name, 'cmap', k, [(distances_cmap, positions_cmap)])
 
 
-def fa2sql(fasta, enzyme_site, db_name, k):
+def fa2sql(fasta, enzyme_site, db_name, k, n_threads, storage_type):
     import process_fasta as pf
     import make_sql
+    import storage
+    import cache
+    backend = storage.get_backend(storage_type)
 
-    contigs_fasta = pf.get_contigs(fasta)
-    positions_fasta = pf.get_recognition_site(contigs_fasta, enzyme_site)
-    distances_fasta, distance_list_fasta = make_sql.get_distance(positions_fasta)
-    make_sql.make_db(distances_fasta, db_name, k, positions_fasta, "fasta")
+    pf.index_fasta(fasta, cache.get_sequence_path(db_name))
+    contigs_fasta = pf.load_contigs(cache.get_sequence_path(db_name))
+    # The k-mers of each batch of contigs are written while the workers find the sites of the next contigs
+    positions_fasta = pf.get_recognition_site_batches(contigs_fasta, enzyme_site, n_threads)
+    with metrics.stage('make_db', table='fasta', storage_type=storage_type, workers=int(n_threads)) as record:
+        record['rows'] = backend.write_kmers(db_name, 'fasta', k, make_sql.get_kmer_batches(positions_fasta))
 
     return contigs_fasta
 
+def make_index(args):
+    """
+    Makes the index of the input files, or reuses it from the cache when the same input files and settings were
+    indexed before, and copies it to the tables of the run
+    :param args: parsed command line arguments
+    :return: cache key of the index
+    :return: path to the index in the cache directory, without extension
+    """
+    import cache
+    import storage
+    backend = storage.get_backend(args.storage_type)
+
+    key = cache.get_input_key(args.Fasta, args.cmap, args.Enzyme_site, args.k_mer, args.storage_type)
+    cache_dir = args.cache_dir if args.cache_dir else "{}_cache".format(args.prefix)
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_db_name = os.path.join(cache_dir, key)
+    if cache.is_cached(cache_db_name):
+        print("Using cached index: {}".format(cache_db_name))
+    else:
+        backend.remove_tables(cache_db_name)
+        # The cmap and the fasta file are indexed at the same time, the cmap in its own process
+        cmap_process = Process(target=cmap2sql, args=(args.cmap, cache_db_name, args.k_mer, args.storage_type))
+        cmap_process.start()
+        fa2sql(args.Fasta, args.Enzyme_site, cache_db_name, args.k_mer, args.n_threads, args.storage_type)
+        cmap_process.join()
+        if cmap_process.exitcode != 0:
+            print("Indexing the cmap failed")
+            sys.exit(1)
+        cache.mark_cached(cache_db_name)
+    backend.copy_tables(cache_db_name, args.prefix)
+    return key, cache_db_name
+
+
 def assemble(args):
-    cmap2sql(args.cmap, args.prefix, args.k_mer)
-    fa2sql(args.Fasta, args.Enzyme_site, args.prefix, args.k_mer)
+    metrics.configure(args.metrics, args.profile.split(',') if args.profile else (), args.prefix)
+    key, cache_db_name = make_index(args)
 
     import run_map_fasta_parallel as mf
     import remove_pos as rp
     import find_overlaps_np_parallel as fo
     import process_fasta as pf
     import make_output as mo
+    import shared_arrays as sa
+    import cache
 
     rounds_list = args.overlap_len.split(',')
     print(rounds_list)
     deviation_list = args.deviationlist.split(',')
-    fasta_seq_dict = pf.get_contigs(args.Fasta)
+    # The sequences are memory-mapped from the cache, so the merge workers of every round read only the parts they
+    # slice, without a copy
+    fasta_seq_dict = pf.load_contigs(cache.get_sequence_path(cache_db_name))
+    # with several enzymes the gaps between the mapped sequences start with the site of the first one
+    enzyme_sequence = pf.get_enzyme_sites(args.Enzyme_site)[0]
+    # a run that was stopped leaves its shared arrays behind
+    sa.remove_old_shared_dirs(args.prefix)
     seq_dict = {}
     mapped_pos_per_round_dict = {}
+    removed_fasta = []
+    removed_cmap = []
+    first_round = 0
 
-    for i in range(len(rounds_list)):
+    settings = {'index': key, 'overlap_len': rounds_list, 'deviationlist': deviation_list,
+                'search_once': args.search_once, 'seed_step': args.seed_step}
+    checkpoint = cache.load_checkpoint(args.prefix, settings)
+    if checkpoint is not None:
+        first_round = checkpoint['round']
+        seq_dict = checkpoint['seq_dict']
+        mapped_pos_per_round_dict = checkpoint['mapped_pos_per_round_dict']
+        removed_fasta = checkpoint['removed_fasta']
+        removed_cmap = checkpoint['removed_cmap']
+        print("Continuing from checkpoint after round: {}".format(first_round - 1))
+        rp.remove_fasta(removed_fasta, args.prefix, args.storage_type)
+        rp.remove_cmap(removed_cmap, args.prefix, args.storage_type)
+
+    if args.search_once and first_round < len(rounds_list):
+        fo.find_overlaps(args.prefix, max(int(deviation) for deviation in deviation_list), args.n_threads, args.storage_type, args.block_size, args.max_memory, seed_step=args.seed_step)
+
+    for i in range(first_round, len(rounds_list)):
         print("Round: {}".format(i))
-        fo.find_overlaps(args.prefix, int(deviation_list[i]), args.n_threads)
-        seq_dict, remove_fa, remove_cmap_list, mapped_pos_number = mf.merge(args.prefix, args.Enzyme_site, fasta_seq_dict, rounds_list[i], args.n_threads, seq_dict)
+        metrics.context['round'] = i
+        if args.search_once:
+            max_deviation = int(deviation_list[i])
+        else:
+            max_deviation = None
+            fo.find_overlaps(args.prefix, int(deviation_list[i]), args.n_threads, args.storage_type, args.block_size, args.max_memory, seed_step=args.seed_step)
+        seq_dict, remove_fa, remove_cmap_list, mapped_pos_number = mf.merge(args.prefix, enzyme_sequence, fasta_seq_dict, rounds_list[i], args.n_threads, seq_dict, args.storage_type, max_deviation)
         mapped_pos_per_round_dict[i] = mapped_pos_number
         print("Number of fasta locations mapped: {}".format(len(remove_fa)))
-        rp.remove_fasta(remove_fa, args.prefix)
-        rp.remove_cmap(remove_cmap_list, args.prefix)
+        rp.remove_fasta(remove_fa, args.prefix, args.storage_type)
+        rp.remove_cmap(remove_cmap_list, args.prefix, args.storage_type)
+        removed_fasta += remove_fa
+        removed_cmap += remove_cmap_list
+        cache.save_checkpoint(args.prefix, settings, i + 1, seq_dict, mapped_pos_per_round_dict, removed_fasta,
+                              removed_cmap)
     mo.counter_file(args.prefix, mapped_pos_per_round_dict)
     mo.make_fasta(args.prefix, seq_dict)
+    cache.remove_checkpoint(args.prefix)
 
 
 
-def main():
-    parser = argparse.ArgumentParser(description = "Make a de novo assembly by combining Optical mapping data with long read sequencing data.")
+def prepare_shards(args):
+    """
+    Makes the index of a sharded run and writes its manifest, with the fasta contigs each shard job maps
+    :param args: parsed command line arguments
+    :return: None
+    """
+    if args.search_once:
+        print("--search_once can not be used in a sharded run")
+        sys.exit(1)
+    metrics.configure(args.metrics, args.profile.split(',') if args.profile else (), args.prefix)
+    key, cache_db_name = make_index(args)
+
+    import process_fasta as pf
+    import shards as sh
+    import cache
 
+    fasta_seq_dict = pf.load_contigs(cache.get_sequence_path(cache_db_name))
+    fasta_list = list(fasta_seq_dict.keys())
+    # a new sharded run starts from the first round
+    cache.remove_checkpoint(args.prefix)
+    sh.remove_shard_results(args.prefix)
+    manifest = {'index': key,
+                'Fasta': args.Fasta,
+                'sequences': cache.get_sequence_path(cache_db_name),
+                'cmap': args.cmap,
+                'Enzyme_site': args.Enzyme_site,
+                'storage_type': args.storage_type,
+                'overlap_len': args.overlap_len.split(','),
+                'deviationlist': args.deviationlist.split(','),
+                'seed_step': args.seed_step,
+                'round': 0,
+                'n_shards': args.n_shards,
+                'fasta_list': fasta_list,
+                'shards': sh.split_contigs(fasta_seq_dict, args.n_shards)}
+    sh.write_manifest(args.prefix, manifest)
+    print("Prepared {} shards, run the shards of round 0".format(args.n_shards))
 
+
+def run_shard(args):
+    """
+    Finds the overlaps and the mapping of the fasta contigs of one shard in the current round of a sharded run
+    :param args: parsed command line arguments
+    :return: None
+    """
+    import run_map_fasta_parallel as mf
+    import find_overlaps_np_parallel as fo
+    import shared_arrays as sa
+    import shards as sh
+    import storage
+
+    manifest = sh.read_manifest(args.prefix)
+    i = manifest['round']
+    if i >= len(manifest['overlap_len']):
+        print("All rounds are merged")
+        return
+    if not 0 <= args.shard < manifest['n_shards']:
+        print("Shard must be between 0 and {}".format(manifest['n_shards'] - 1))
+        sys.exit(1)
+    print("Round: {}, shard: {}".format(i, args.shard))
+    backend = storage.get_backend(manifest['storage_type'])
+    shard_db_name = sh.get_shard_db_name(args.prefix, args.shard)
+    metrics.configure(args.metrics, args.profile.split(',') if args.profile else (), shard_db_name)
+    metrics.context.update({'round': i, 'shard': args.shard})
+    sa.remove_old_shared_dirs(shard_db_name)
+    # Each shard writes its overlaps to its own copy of the index, which has the k-mers removed in earlier rounds
+    backend.copy_tables(args.prefix, shard_db_name)
+
+    fasta_list = manifest['shards'][args.shard]
+    fo.find_overlaps(shard_db_name, int(manifest['deviationlist'][i]), args.n_threads, manifest['storage_type'],
+                     args.block_size, args.max_memory, fasta_list, manifest['seed_step'])
+    with metrics.stage('get_fasta_mapping_info', workers=int(args.n_threads), fasta_contigs=len(fasta_list)):
+        mapped_fasta_temp = mf.get_fasta_mapping_info(shard_db_name, manifest['overlap_len'][i], fasta_list,
+                                                      args.n_threads, manifest['storage_type'])
+    sh.save_shard_result(args.prefix, manifest, args.shard, dict(zip(fasta_list, mapped_fasta_temp)))
+    backend.remove_tables(shard_db_name)
+
+
+def merge_shards(args):
+    """
+    Combines the shard results of the current round of a sharded run, adds the mapped sequences to the scaffolds and
+    removes the mapped k-mers from the index. After the last round the output files are written.
+    :param args: parsed command line arguments
+    :return: None
+    """
+    metrics.configure(args.metrics, args.profile.split(',') if args.profile else (), args.prefix)
+
+    import run_map_fasta_parallel as mf
+    import remove_pos as rp
+    import process_fasta as pf
+    import make_output as mo
+    import shared_arrays as sa
+    import shards as sh
+    import cache
+
+    manifest = sh.read_manifest(args.prefix)
+    i = manifest['round']
+    rounds_list = manifest['overlap_len']
+    if i >= len(rounds_list):
+        print("All rounds are merged")
+        return
+    seq_dict = {}
+    mapped_pos_per_round_dict = {}
+    removed_fasta = []
+    removed_cmap = []
+
+    settings = {'index': manifest['index'], 'overlap_len': rounds_list, 'deviationlist': manifest['deviationlist'],
+                'search_once': False}
+    checkpoint = cache.load_checkpoint(args.prefix, settings)
+    if checkpoint is not None:
+        seq_dict = checkpoint['seq_dict']
+        mapped_pos_per_round_dict = checkpoint['mapped_pos_per_round_dict']
+        removed_fasta = checkpoint['removed_fasta']
+        removed_cmap = checkpoint['removed_cmap']
+
+    # a merge that was stopped after its checkpoint was saved only has to move the run to the next round
+    if checkpoint is None or checkpoint['round'] <= i:
+        print("Round: {}".format(i))
+        metrics.context['round'] = i
+        mapped_fasta_temp = sh.load_shard_results(args.prefix, manifest)
+        fasta_seq_dict = pf.load_contigs(manifest['sequences'])
+        enzyme_sequence = pf.get_enzyme_sites(manifest['Enzyme_site'])[0]
+        sa.remove_old_shared_dirs(args.prefix)
+        seq_dict, remove_fa, remove_cmap_list, mapped_pos_number = mf.merge(args.prefix, enzyme_sequence, fasta_seq_dict, rounds_list[i], args.n_threads, seq_dict, manifest['storage_type'], mapped_fasta_temp=mapped_fasta_temp)
+        mapped_pos_per_round_dict[i] = mapped_pos_number
+        print("Number of fasta locations mapped: {}".format(len(remove_fa)))
+        rp.remove_fasta(remove_fa, args.prefix, manifest['storage_type'])
+        rp.remove_cmap(remove_cmap_list, args.prefix, manifest['storage_type'])
+        removed_fasta += remove_fa
+        removed_cmap += remove_cmap_list
+        cache.save_checkpoint(args.prefix, settings, i + 1, seq_dict, mapped_pos_per_round_dict, removed_fasta,
+                              removed_cmap)
+
+    manifest['round'] = i + 1
+    sh.write_manifest(args.prefix, manifest)
+    sh.remove_shard_results(args.prefix, i)
+    if i + 1 < len(rounds_list):
+        print("Merged round {}, run the shards of round {}".format(i, i + 1))
+        return
+    mo.counter_file(args.prefix, mapped_pos_per_round_dict)
+    mo.make_fasta(args.prefix, seq_dict)
+    cache.remove_checkpoint(args.prefix)
+
+
+def add_run_arguments(parser):
+    """
+    Adds the options used while finding overlaps and merging
+    :param parser: argparse parser of a command
+    :return: None
+    """
+    parser.add_argument("--n_threads", "-c", type=int, default = 16, help="Number of threads to use during mapping.")
+    parser.add_argument("--block_size", "-b", type=int, default=0, help = "Number of fasta k-mers compared to the cmap k-mers in one task while finding overlaps. With 0 the blocks are sized from the available memory.")
+    parser.add_argument("--max_memory", "-m", type=float, default=None, help = "Memory budget in GB used to size the blocks of fasta k-mers compared at once while finding overlaps. Defaults to the available memory. Not used with --block_size.")
+    parser.add_argument("--metrics", type=str, default=None, help = "Append the wall time, CPU time, memory use and row counts of each stage to this file as JSON lines.")
+    parser.add_argument("--profile", type=str, default=None, help = "Comma-separated names of stages to run under cProfile, e.g. find_overlaps,merge_fa_cmap. The profiles are written to <prefix>.<stage>.<n>.prof.")
+
+
+def add_assemble_arguments(parser):
+    """
+    Adds the input files and the settings of a run
+    :param parser: argparse parser of a command
+    :return: None
+    """
     parser.add_argument("Fasta", type = str, help = "Path to fasta file that contains long read sequencing data.")
     parser.add_argument("cmap", type = str, help = "Path to cmap file with optical mapping data.")
-    parser.add_argument("Enzyme_site", type = str, help = "Recognition site of the enzyme using in optical mapping.")
+    parser.add_argument("Enzyme_site", type = str, help = "Recognition site of the enzyme using in optical mapping. For a cmap made with several enzymes, give the sites of all enzymes separated by commas, e.g. GCTCTTC,CTTAAG.")
     parser.add_argument("prefix", type=str, help="Prefix of the final output file. Will be in fasta format.")
-    parser.add_argument("--n_threads", "-c", type=int, default = 16, help="Number of threads to use during mapping.")
+    add_run_arguments(parser)
     parser.add_argument("--k_mer", "-k", type = int, default = 5, help = "K-mer size used for overlapping fasta and optical mapping sites. Larger genomes will require larger k-mer sizes. Larger k-mer sizes lower sensitivity.")
     parser.add_argument("--deviationlist", "-D", type=str, default="500,1000,2000", help = "The max deviation applied to find overlaps for each round of alignment")
     parser.add_argument("--overlap_len", "-o", type=str, default="6,8,10", help = "The number of positions that have to overlap at least for an alignment to be considered correct")
+    parser.add_argument("--storage_type", "-s", type=str, default="sqlite", choices=["sqlite", "columnar"], help = "How the index tables are stored between stages: in a sqlite database (<prefix>.db) or as memory-mapped numpy arrays (<prefix>_columnar/).")
+    parser.add_argument("--seed_step", type=int, default=1, help = "Compare only every seed_step-th fasta k-mer to the cmap k-mers and find the other overlaps by extending the overlaps of these seeds. Consecutive overlaps of at least seed_step k-mers are always found, so a seed_step up to the smallest overlap_len + 1 gives the same result faster, and larger steps are faster but can miss shorter overlaps. With 1 every k-mer is compared.")
+    parser.add_argument("--search_once", action="store_true", help = "Find the overlaps of all rounds in one search at the largest deviation, and select the overlaps of each round from these.")
+    parser.add_argument("--cache_dir", type=str, default=None, help = "Directory where the index of the input files is kept, so runs on the same input files and k-mer size reuse it. Defaults to <prefix>_cache.")
     parser.add_argument("--w_fasta", "-w", type=bool, default=True, help = "Set to false if no sequence file should be made at the end.")
+
+
+SHARD_COMMANDS = ['prepare', 'shard', 'merge']
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in SHARD_COMMANDS:
+        # A sharded run is done in steps: prepare once, then for each round all shard jobs followed by a merge
+        parser = argparse.ArgumentParser(description = "Run the assembly in shards that can run as separate jobs on nodes that share a filesystem.")
+        subparsers = parser.add_subparsers(dest="command", required=True)
+        prepare_parser = subparsers.add_parser("prepare", help = "Make the index and the manifest of a sharded run.")
+        add_assemble_arguments(prepare_parser)
+        prepare_parser.add_argument("--n_shards", "-n", type=int, required=True, help = "Number of shards the fasta contigs are split into.")
+        prepare_parser.set_defaults(func=prepare_shards)
+        shard_parser = subparsers.add_parser("shard", help = "Find the overlaps and mappings of one shard in the current round.")
+        shard_parser.add_argument("prefix", type=str, help="Prefix of the sharded run.")
+        shard_parser.add_argument("shard", type=int, help="Number of the shard, from 0 to n_shards - 1.")
+        add_run_arguments(shard_parser)
+        shard_parser.set_defaults(func=run_shard)
+        merge_parser = subparsers.add_parser("merge", help = "Combine the shard results of the current round and remove the mapped k-mers. After the last round the output is written.")
+        merge_parser.add_argument("prefix", type=str, help="Prefix of the sharded run.")
+        add_run_arguments(merge_parser)
+        merge_parser.set_defaults(func=merge_shards)
+        args = parser.parse_args(sys.argv[1:])
+        args.func(args)
+        return
+
+    parser = argparse.ArgumentParser(description = "Make a de novo assembly by combining Optical mapping data with long read sequencing data.")
+    add_assemble_arguments(parser)
     parser.set_defaults(func=assemble)
     args = parser.parse_args(sys.argv[1:])
     args.func(args)
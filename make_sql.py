@@ -1,10 +1,32 @@
 import sqlite3
 import time
 
+BULK_LOAD_PRAGMAS = ["PRAGMA journal_mode = MEMORY;",
+                     "PRAGMA synchronous = OFF;",
+                     "PRAGMA cache_size = -262144;",
+                     "PRAGMA temp_store = MEMORY;"]
+# The cmap and fasta tables are loaded at the same time by 2 processes, so a connection waits for the transaction of
+# the other one to finish instead of failing
+BUSY_TIMEOUT = 24 * 3600
+
+
+def connect_bulk(db_name):
+    """
+    Opens a connection to the sql database that is tuned for loading large tables in a single transaction. The
+    rollback journal is kept in memory and writes are not synced to disk until the transaction is committed.
+    :param db_name: name of the sql database
+    :return: connection to the sql database
+    """
+    connection = sqlite3.connect("{}.db".format(db_name), timeout=BUSY_TIMEOUT)
+    for pragma in BULK_LOAD_PRAGMAS:
+        connection.execute(pragma)
+    return connection
+
 
 def get_distance(sites):
     """
-    This function loops over all contigs/cmaps and calculates the distances between each consecutive enzyme site.
+    This function loops over all contigs/cmaps and calculates the distances between each consecutive enzyme site. The
+    distances of '<contig name>_reverse' are the distances of the contig in reverse order.
     :param sites: dictionary with format: {'contig/cmap name' : [ordered list of enzyme site locations]}
     :return: distances: dictionary with format {'congtig/cmap name' : [list of distances (ordered)]}
     :return: distance_list: contains all distances in one list
@@ -12,6 +34,11 @@ def get_distance(sites):
     distances = {}
     distance_list = []
     for seq in sites:
+        # the sites of a reverse complement are the mirrored sites of the contig, so the distances are reversed
+        if seq.endswith('_reverse') and seq[:-len('_reverse')] in distances:
+            distances[seq] = distances[seq[:-len('_reverse')]][::-1]
+            distance_list += distances[seq]
+            continue
         distances[seq] = []
         for i in range(len(sites[seq]) - 1):
             distance = sites[seq][i + 1] - sites[seq][i]
@@ -21,39 +48,66 @@ def get_distance(sites):
     return distances, distance_list
 
 
-def kmer_table(cursor, distance_columns, table_type, index_column_count, col_number, table_content):
+def get_kmer_batches(site_batches):
+    """
+    This generator calculates the distances between consecutive enzyme sites for each batch of contigs as the batches
+    come, like get_distance. The distances of '<contig name>_reverse' are the distances of the contig in reverse order.
+    :param site_batches: iterable of dictionaries with format: {'contig/cmap name' : [ordered list of enzyme site
+        locations]}
+    :return: generator of tuples with format (distances, sites), with distances in the format of get_distance
+    """
+    forward_distances = {}
+    for sites in site_batches:
+        distances = {}
+        for seq in sites:
+            if seq.endswith('_reverse') and seq[:-len('_reverse')] in forward_distances:
+                distances[seq] = forward_distances.pop(seq[:-len('_reverse')])[::-1]
+                continue
+            distances[seq] = [sites[seq][i + 1] - sites[seq][i] for i in range(len(sites[seq]) - 1)]
+            forward_distances[seq] = distances[seq]
+        yield distances, sites
+    print("Finished get_distances")
+
+
+def kmer_table(cursor, distance_columns, table_type):
     """
     This function creates the table that contains all distances between enzyme sites on the cmap/fasta contig.
     The table has 3 standard columns that contain the ID (primary key of the entry), contig (name of the cmap/fasta),
     and the pos_contig (which positions all the distances in this row are linked to), there is also one column for
     each of the distances per row, the number of distances depends on the chosen k-mer length,
-    where number distances = k-mer length
+    where number distances = k-mer length. The last column, active, is set to 0 when the k-mer is removed.
     :param cursor: connection to the sql database
     :param distance_columns: list with the names of the distance columns
     :param table_type: fasta or cmap
-    :param index_column_count: list with the names of the distance columns to index the table
-    :param col_number: string with a ? for each column in the table
-    :param table_content: The actual information to fill up the table after table creation
     :return: None
     """
     create_kmer_table = """
         CREATE TABLE {} (
-        id VARCHAR PRIMARY KEY,
+        id INTEGER PRIMARY KEY,
         contig VARCHAR(255) NOT NULL,
         pos_contig INT NOT NULL,
-        {}
+        {},
+        active INT NOT NULL DEFAULT 1
         );
         """.format(table_type, distance_columns)
     cursor.execute(create_kmer_table)
-    cursor.executemany('INSERT INTO {} VALUES ({})'.format(table_type, col_number), table_content)
-   
+
+
+def distance_index(cursor, table_type, index_column_count):
+    """
+    This function indexes the distance table on its distances, after the table is filled
+    :param cursor: connection to the sql database
+    :param table_type: fasta or cmap
+    :param index_column_count: list with the names of the distance columns to index the table
+    :return: None
+    """
     create_index = """
         CREATE INDEX idx_distances_{}
         ON {} ({});""".format(table_type, table_type, index_column_count)
     cursor.execute(create_index)
 
 
-def contig_table(cursor, position_columns, table_type, col_number, table_content):
+def contig_table(cursor, position_columns, table_type):
     """
     This function creates the table that contains all positions of enzyme sites on the cmap/fasta contig.
     The table has 3 standard columns that contain the ID (primary key of the entry), contig (name of the cmap/fasta),
@@ -63,13 +117,11 @@ def contig_table(cursor, position_columns, table_type, col_number, table_content
     :param cursor: connection to the sql database
     :param position_columns: list with the names of the position columns
     :param table_type: fasta or cmap
-    :param col_number: string with a ? for each column in the table
-    :param table_content: The actual information to fill up the table after table creation
     :return: None
     """
     create_contigs_table = """
         CREATE TABLE {}_contigs (
-        id INT PRIMARY KEY,
+        id INTEGER PRIMARY KEY,
         contig VARCHAR(255) NOT NULL,
         pos_contig INT NOT NULL,
         {}
@@ -77,7 +129,25 @@ def contig_table(cursor, position_columns, table_type, col_number, table_content
         """.format(table_type, position_columns)
     cursor.execute(create_contigs_table)
 
-    cursor.executemany('INSERT INTO {}_contigs VALUES (?,{})'.format(table_type, col_number), table_content)
+
+def first_id_table(cursor, table_type):
+    """
+    This function creates the table with the ID of the first k-mer of each cmap/fasta contig. The k-mers of a contig
+    have consecutive IDs, so the ID of a k-mer is first_id + pos_contig - 1, which is used to remove k-mers by their
+    primary key.
+    :param cursor: connection to the sql database
+    :param table_type: fasta or cmap
+    :return: None
+    """
+    create_first_id_table = """
+        CREATE TABLE {}_first_id (
+        contig VARCHAR(255) PRIMARY KEY,
+        first_id INT NOT NULL
+        );
+        """.format(table_type)
+    cursor.execute(create_first_id_table)
+    cursor.execute("""INSERT INTO {}_first_id
+        SELECT contig, MIN(id) FROM {}_contigs GROUP BY contig;""".format(table_type, table_type))
 
 
 def get_column_count(n_distances):
@@ -110,64 +180,60 @@ def get_column_count(n_distances):
     return distance_columns, index_column_count, position_columns, col_number
 
 
-def get_table_content(distance_list, n_distances, id_counter, sites, contig, distances):
+def get_table_content(distances, sites, n_distances, positions, id_counter=1):
     """
-    This function generates the input for the distance and position sql tables.
-    :param distance_list: A list of ordered distances between consecutive enzyme sites for 1 contig
-    :param n_distances: number of distances per row
-    :param id_counter: counter to have a unique ID per table entry
-    :param sites: dictionary with format: {'contig/cmap name' : [ordered list of enzyme site locations]}
-    :param contig: name of the contig
+    This generator yields the rows of the distance or position sql table, as tuples of integers, for all contigs.
+    Both tables get the same ID for the same k-mer.
     :param distances: dictionary with format {'congtig/cmap name' : [list of distances (ordered)]}
-    :return: values: list
+    :param sites: dictionary with format: {'contig/cmap name' : [ordered list of enzyme site locations]}
+    :param n_distances: number of distances per row
+    :param positions: True to yield the rows of the position table, False for the rows of the distance table
+    :param id_counter: ID of the first row
+    :return: generator of tuples with format (id, contig, pos_contig, distance_1/position_1, ...)
     """
-    k = 1
-    values = []
-    positions = []
-    for i in range(len(distance_list) - n_distances):
-        values_temp = [str(id_counter), contig, str(k)]
-        positions_temp = [str(id_counter), contig, str(k)]
-        k += 1
-        id_counter += 1
-
-        for j in range(n_distances+1):
-            values_temp.append(str(distances[contig][i + j]))
-            positions_temp.append(str(sites[contig][i + j]))
-        del (values_temp[-1])
-        values.append(values_temp)
-        positions.append(positions_temp)
-    return values, positions, id_counter
+    for contig in distances:
+        distance_list = distances[contig]
+        for i in range(len(distance_list) - n_distances):
+            if positions:
+                row = sites[contig][i:i + n_distances + 1]
+            else:
+                row = distance_list[i:i + n_distances]
+            yield (id_counter, contig, i + 1, *row)
+            id_counter += 1
 
 
-def make_db(distances, db_name, n_distances, sites, table_type):
+def make_db(kmer_batches, db_name, n_distances, table_type):
     """
     This function calls all functions required to initiate the sql database and connects to the database to enter
-    all table information.
-    :param distances: dictionary with format {'congtig/cmap name' : [list of distances (ordered)]}
+    all table information. The rows of each batch of contigs are streamed into the tables as the batch comes, all in a
+    single transaction, and the index is created after the distance table is filled.
+    :param kmer_batches: iterable of tuples with format (distances, sites), with distances a dictionary with format
+        {'congtig/cmap name' : [list of distances (ordered)]} and sites a dictionary with format:
+        {'contig/cmap name' : [ordered list of enzyme site locations]}
     :param db_name: name of the sql database
     :param n_distances: number of distances per row
-    :param sites: dictionary with format: {'contig/cmap name' : [ordered list of enzyme site locations]}
     :param table_type: fastq ir cmap
-    :return: None
+    :return: number of k-mers written
     """
     t = time.time()
     print("Start making db, {}".format(table_type))
-    connection = sqlite3.connect("{}.db".format(db_name))
+    connection = connect_bulk(db_name)
     cursor = connection.cursor()
-    id_counter = 1
 
     distance_columns, index_column_count, position_columns, col_number = get_column_count(n_distances)
 
-    pop_table = []
-    pop_contigs = []
-    for contig in distances:
-        distance_list = distances[contig]
-        values, positions, id_counter = get_table_content(distance_list, n_distances, id_counter,
-                                                          sites, contig, distances)
-        pop_table += values
-        pop_contigs += positions
-    kmer_table(cursor, distance_columns, table_type, index_column_count, col_number, pop_table)
-    contig_table(cursor, position_columns, table_type, col_number, pop_contigs)
+    kmer_table(cursor, distance_columns, table_type)
+    contig_table(cursor, position_columns, table_type)
+    n_kmers = 0
+    for distances, sites in kmer_batches:
+        cursor.executemany('INSERT INTO {} (id, contig, pos_contig, {}) VALUES ({})'.format(
+            table_type, index_column_count, col_number),
+            get_table_content(distances, sites, n_distances, False, n_kmers + 1))
+        cursor.executemany('INSERT INTO {}_contigs VALUES (?,{})'.format(table_type, col_number),
+                           get_table_content(distances, sites, n_distances, True, n_kmers + 1))
+        n_kmers += sum(max(len(distances[contig]) - n_distances, 0) for contig in distances)
+    distance_index(cursor, table_type, index_column_count)
+    first_id_table(cursor, table_type)
     connection.commit()
     print("Finished populating database, took; {}".format(time.time()-t))
-
+    return n_kmers
@@ -0,0 +1,138 @@
+import cProfile
+import json
+import resource
+import time
+from contextlib import contextmanager
+import psutil
+
+# Each pipeline stage is wrapped in stage(), which measures it and, when a metrics file is set with configure, writes
+# one JSON line per stage to it. Stages named in profile_stages are also run under cProfile. joblib workers never call
+# configure, so they write no metrics, but a multiprocessing.Process forked after configure, like the process that
+# indexes the cmap, inherits the settings and writes the records of its own stages.
+
+settings = {'path': None, 'profile_stages': set(), 'prefix': None}
+context = {}
+profile_counts = {}
+
+
+def configure(path=None, profile_stages=(), prefix='run'):
+    """
+    Sets where the metrics are written and which stages are profiled
+    :param path: path to the JSON lines file the metrics are appended to, or None to not write metrics
+    :param profile_stages: names of the stages to run under cProfile
+    :param prefix: prefix of the .prof files, which are named <prefix>.<stage>.<n>.prof
+    :return: None
+    """
+    settings['path'] = path
+    settings['profile_stages'] = set(profile_stages)
+    settings['prefix'] = prefix
+
+
+def get_worker_cpu_time():
+    """
+    Sums the user and system CPU time of all child processes, such as the joblib workers
+    :return: CPU time in seconds
+    """
+    cpu_time = 0.0
+    for child in psutil.Process().children(recursive=True):
+        try:
+            times = child.cpu_times()
+            cpu_time += times.user + times.system
+        except psutil.Error:
+            continue
+    return cpu_time
+
+
+def get_rss():
+    """
+    Returns the resident memory of this process
+    :return: resident memory in MB
+    """
+    return psutil.Process().memory_info().rss / 2.**20
+
+
+def get_worker_rss():
+    """
+    Sums the resident memory of all child processes
+    :return: resident memory in MB
+    """
+    rss = 0
+    for child in psutil.Process().children(recursive=True):
+        try:
+            rss += child.memory_info().rss
+        except psutil.Error:
+            continue
+    return rss / 2.**20
+
+
+def write_record(record):
+    """
+    Appends one record to the metrics file
+    :param record: dictionary with the metrics of one stage
+    :return: None
+    """
+    with open(settings['path'], 'a') as file:
+        file.write(json.dumps(record, default=str) + '\n')
+
+
+@contextmanager
+def stage(name, **info):
+    """
+    Measures one pipeline stage. The dictionary it yields can be filled with counts, such as rows and hits, that are
+    only known when the stage is done.
+    :param name: name of the stage
+    :param info: counts and settings of the stage that are known at the start, such as the number of workers
+    :return: dictionary that is written with the metrics of the stage
+    """
+    record = dict(info)
+    profile = name in settings['profile_stages']
+    if settings['path'] is None and not profile:
+        yield record
+        return
+
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    wall_start = time.time()
+    cpu_start = time.process_time()
+    worker_cpu_start = get_worker_cpu_time()
+    rss_start = get_rss()
+    try:
+        yield record
+    finally:
+        wall_time = time.time() - wall_start
+        cpu_time = time.process_time() - cpu_start
+        if profile:
+            profiler.disable()
+            profile_counts[name] = profile_counts.get(name, 0) + 1
+            profiler.dump_stats("{}.{}.{}.prof".format(settings['prefix'], name, profile_counts[name]))
+
+    if settings['path'] is not None:
+        write_stage(name, wall_time, cpu_time, get_worker_cpu_time() - worker_cpu_start, record, rss_start)
+
+
+def write_stage(name, wall_time, cpu_time, worker_cpu_time, record, rss_start=None):
+    """
+    Writes the metrics of one stage to the metrics file, when one is set. Used by stage, and by generators that time
+    only their own part of a stage that is interleaved with the next one.
+    :param name: name of the stage
+    :param wall_time: wall time of the stage in seconds
+    :param cpu_time: CPU time of the main process in seconds
+    :param worker_cpu_time: CPU time of the child processes in seconds
+    :param record: dictionary with the counts and settings of the stage
+    :param rss_start: resident memory of the process at the start of the stage in MB, as returned by get_rss
+    :return: None
+    """
+    if settings['path'] is not None:
+        metrics = {'stage': name}
+        metrics.update(context)
+        metrics.update({'wall_time': wall_time,
+                        'cpu_time': cpu_time,
+                        'worker_cpu_time': max(0.0, worker_cpu_time),
+                        'rss_start_mb': rss_start,
+                        'rss_mb': get_rss(),
+                        # ru_maxrss is the peak of the whole process up to now, not of this stage, in KB on Linux
+                        'process_peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2.**10,
+                        'worker_rss_mb': get_worker_rss()})
+        metrics.update(record)
+        write_record(metrics)
@@ -0,0 +1,88 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True
+import numpy as np
+cimport numpy as np
+from cython.parallel cimport prange
+from libc.stdlib cimport qsort
+
+# Typed kernel of the overlap search. compare_rows releases the GIL and splits the fasta k-mers of a block over the
+# threads with OpenMP, so one process uses all cores without sending the arrays to worker processes.
+# find_overlaps_np_parallel uses the NumPy code instead when this module is not built.
+
+
+cdef inline long get_row_deviation(const np.int32_t[:, ::1] block, const np.int32_t[:, ::1] sorted_cmap,
+                                   Py_ssize_t row, Py_ssize_t cmap_row, long deviation) noexcept nogil:
+    """
+    Returns the largest difference between the distances of a fasta and a cmap k-mer, or the first difference that is
+    larger than the deviation
+    """
+    cdef Py_ssize_t d
+    cdef long difference
+    cdef long largest = 0
+    for d in range(block.shape[1]):
+        difference = <long>block[row, d] - <long>sorted_cmap[cmap_row, d]
+        if difference < 0:
+            difference = -difference
+        if difference > largest:
+            largest = difference
+            if largest > deviation:
+                break
+    return largest
+
+
+cdef int compare_keys(const void *a, const void *b) noexcept nogil:
+    cdef np.int64_t key_a = (<const np.int64_t *>a)[0]
+    cdef np.int64_t key_b = (<const np.int64_t *>b)[0]
+    return (key_a > key_b) - (key_a < key_b)
+
+
+def compare_rows(const np.int32_t[:, ::1] block, const np.int32_t[:, ::1] sorted_cmap, const np.int64_t[::1] order,
+                 const np.int64_t[::1] lower, const np.int64_t[::1] upper, long deviation, int n_threads=1):
+    """
+    Finds all cmap k-mers of which every distance lies within the deviation of the distances of each fasta k-mer of a
+    block. The hits of each fasta k-mer are counted first, so the output can be filled in place by all threads.
+    :param block: 2D int32 array with format [[distance_1 distance_2 ... distance_n]], 1 row per fasta k-mer
+    :param sorted_cmap: 2D int32 cmap distance matrix sorted on distance_1, as made by build_cmap_index
+    :param order: original row index of each row in sorted_cmap, as made by build_cmap_index
+    :param lower: first row of sorted_cmap in the window of each fasta k-mer, as found by get_windows
+    :param upper: row after the last row of sorted_cmap in the window of each fasta k-mer
+    :param deviation: max deviation allowed between a fasta and a cmap distance
+    :param n_threads: the number of threads that can be used for computation
+    :return: block_rows: numpy array with the row in block of each overlap
+    :return: cmap_rows: numpy array with the cmap row of each overlap
+    :return: hit_deviation: numpy array with the largest difference between a fasta and a cmap distance of each overlap
+    The overlaps are ordered by block row and then by cmap row.
+    """
+    cdef Py_ssize_t n_rows = block.shape[0]
+    cdef Py_ssize_t i, j, k
+    cdef long largest
+    counts_array = np.zeros(n_rows, dtype=np.int64)
+    cdef np.int64_t[::1] counts = counts_array
+
+    with nogil:
+        for i in prange(n_rows, num_threads=n_threads, schedule='dynamic', chunksize=64):
+            for j in range(lower[i], upper[i]):
+                if get_row_deviation(block, sorted_cmap, i, j, deviation) <= deviation:
+                    counts[i] = counts[i] + 1
+
+    offsets_array = np.cumsum(counts_array) - counts_array
+    cdef np.int64_t[::1] offsets = offsets_array
+    keys_array = np.zeros(int(counts_array.sum()), dtype=np.int64)
+    cdef np.int64_t[::1] keys = keys_array
+
+    with nogil:
+        for i in prange(n_rows, num_threads=n_threads, schedule='dynamic', chunksize=64):
+            if counts[i] == 0:
+                continue
+            k = offsets[i]
+            for j in range(lower[i], upper[i]):
+                largest = get_row_deviation(block, sorted_cmap, i, j, deviation)
+                if largest <= deviation:
+                    # the cmap row and the deviation share 1 key, so sorting the keys orders the hits by cmap row
+                    keys[k] = (order[j] << 32) | largest
+                    k = k + 1
+            if counts[i] > 1:
+                qsort(&keys[offsets[i]], counts[i], sizeof(np.int64_t), compare_keys)
+
+    block_rows = np.repeat(np.arange(n_rows, dtype=np.int64), counts_array)
+    return block_rows, keys_array >> 32, keys_array & 0xffffffff
+
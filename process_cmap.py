@@ -1,5 +1,40 @@
-import sqlite3
 import time
+import numpy as np
+import make_sql
+
+CMAP_DTYPE = [('contig', np.int64), ('length', np.float64), ('position', np.float64)]
+
+
+def read_cmap(cmap, chunk_size=2**26):
+    """
+    Function that streams the cmap file in chunks of lines and parses each chunk in bulk into typed numpy arrays, so
+    the file is never held in memory as text
+    :param cmap: String that contains the path to the cmap file to be used during alignment
+    :param chunk_size: Approximate number of bytes read and parsed at a time
+    :return: contig_ids: numpy int64 array with the cmap id of each label
+    :return: label_positions: numpy int64 array with the (rounded) position of each label
+    :return: contig_lengths: numpy int64 array with the (rounded) length of the cmap of each label
+    """
+    chunks = []
+    with open(cmap, 'r') as f:
+        while True:
+            lines = f.readlines(chunk_size)
+            if not lines:
+                break
+            lines = [line for line in lines if not line.startswith('#') and line.strip()]
+            if lines:
+                chunks.append(np.loadtxt(lines, dtype=CMAP_DTYPE, usecols=(0, 1, 5), ndmin=1))
+    if chunks:
+        labels = np.concatenate(chunks)
+    else:
+        labels = np.zeros(0, dtype=CMAP_DTYPE)
+    del chunks
+
+    contig_ids = labels['contig']
+    label_positions = np.rint(labels['position']).astype(np.int64)
+    contig_lengths = np.rint(labels['length']).astype(np.int64)
+    return contig_ids, label_positions, contig_lengths
+
 
 def get_positions(cmap):
     """
@@ -10,23 +45,18 @@ def get_positions(cmap):
     """
     t = time.time()
     print("getting positions")
+    contig_ids, label_positions, contig_lengths = read_cmap(cmap)
+    print("read file")
+
+    order = np.argsort(contig_ids, kind='stable')
+    unique_ids, starts = np.unique(contig_ids[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
     positions = {}
     contig_length = {}
-    with open(cmap, 'r') as f:
-        all_inf = f.read()
-    print("read file")
-    split_lines = all_inf.split("\n")
-    del all_inf
-    del split_lines[-1]
-    for line in split_lines:
-        if line.startswith('#'):
-            continue
-        content = line.strip().split('\t')
-        if content[0] not in positions:
-            positions[content[0]] = []
-        pos = int(round(float(content[5]), 0))
-        contig_length[content[0]] = int(round(float(content[1]), 0))
-        positions[content[0]].append(pos)
+    for i in np.argsort(order[starts], kind='stable'):
+        rows = order[starts[i]:ends[i]]
+        positions[str(unique_ids[i])] = label_positions[rows].tolist()
+        contig_length[str(unique_ids[i])] = int(contig_lengths[rows[-1]])
     print("positions obtained, took: {}".format(time.time() -t))
     return positions, contig_length
 
@@ -38,23 +68,17 @@ def make_length_table(contig_length, db_name):
     :param db_name: Name of the sql database
     :return: None
     """
-    connection = sqlite3.connect("{}.db".format(db_name))
+    connection = make_sql.connect_bulk(db_name)
     cursor = connection.cursor()
 
     create_len_table = """
     CREATE TABLE cmap_len (
-    id VARCHAR PRIMARY KEY,
+    id INTEGER PRIMARY KEY,
     contig VARCHAR(255) NOT NULL,
     length INT NOT NULL
     );"""
 
     cursor.execute(create_len_table)
-    i = 1
-    for contig in contig_length:
-        pop_len_table = """
-        INSERT INTO cmap_len VALUES(
-        {},{},{});""".format(i, contig, contig_length[contig])
-
-        cursor.execute(pop_len_table)
-        connection.commit()
-        i += 1
+    cursor.executemany("INSERT INTO cmap_len VALUES (?,?,?);",
+                       ((i + 1, contig, contig_length[contig]) for i, contig in enumerate(contig_length)))
+    connection.commit()
@@ -1,29 +1,156 @@
+import gzip
 import time
-def get_contigs(fasta):
+import numpy as np
+from joblib import Parallel, delayed
+import metrics
+
+COMPLEMENT = bytes.maketrans(b'ACGT', b'TGCA')
+
+
+class ContigView:
+    """
+    Read-only view on one contig in a SequenceStore. Slicing a view returns the sequence as a string, the same way
+    slicing the sequence string did before. A reverse view returns the reverse complement of the contig.
+    """
+    def __init__(self, buffer, start, length, reverse):
+        self.buffer = buffer
+        self.start = start
+        self.length = length
+        self.reverse = reverse
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        return self[:]
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            item = slice(item, item + 1 if item != -1 else None)
+        begin, end, step = item.indices(self.length)
+        if step != 1:
+            raise ValueError("ContigView only supports slices with step 1")
+        end = max(begin, end)
+        if self.reverse:
+            begin, end = self.length - end, self.length - begin
+            return self.buffer[self.start + begin:self.start + end][::-1].tobytes().translate(COMPLEMENT).decode()
+        return self.buffer[self.start + begin:self.start + end].tobytes().decode()
+
+
+class SequenceStore:
+    """
+    Stores all contigs of a fasta file in one contiguous uint8 buffer with a table of offsets, and behaves like the
+    dictionary {'contig name' : 'sequence information'} it replaces. The reverse complement of each contig is available
+    under '<contig name>_reverse' and is read from the forward sequence when it is sliced, so it is never stored.
     """
-    This function extracts all contigs from a fasta file and puts them in a dictionary. For each fasta contig a
-    reverse is also made
+    def __init__(self, buffer, offsets):
+        self.buffer = buffer
+        self.offsets = offsets
+
+    def __len__(self):
+        return 2 * len(self.offsets)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, name):
+        return name in self.offsets or (name.endswith('_reverse') and name[:-len('_reverse')] in self.offsets)
+
+    def keys(self):
+        return list(self.offsets) + ['{}_reverse'.format(contig) for contig in self.offsets]
+
+    def __getitem__(self, name):
+        if name in self.offsets:
+            start, length = self.offsets[name]
+            return ContigView(self.buffer, start, length, False)
+        if name.endswith('_reverse') and name[:-len('_reverse')] in self.offsets:
+            start, length = self.offsets[name[:-len('_reverse')]]
+            return ContigView(self.buffer, start, length, True)
+        raise KeyError(name)
+
+    def subset(self, names):
+        """
+        Makes a SequenceStore on the same buffer with only the given contigs, so a task that needs a few contigs is
+        not sent the offsets of all of them
+        :param names: iterable of contig names, '<contig name>_reverse' selects the contig as well
+        :return: SequenceStore with the contigs in names and their reverse complements
+        """
+        offsets = {}
+        for name in names:
+            if name not in self.offsets and name.endswith('_reverse'):
+                name = name[:-len('_reverse')]
+            offsets[name] = self.offsets[name]
+        return SequenceStore(self.buffer, offsets)
+
+
+def open_fasta(fasta):
+    """
+    Opens a plain or gzip compressed fasta file. BGZF files are gzip files, so they are read the same way.
+    :param fasta: string that contains the path to the fasta file
+    :return: file object that reads the uncompressed fasta in binary mode
+    """
+    with open(fasta, 'rb') as f:
+        magic = f.read(2)
+    if magic == b'\x1f\x8b':
+        return gzip.open(fasta, 'rb')
+    return open(fasta, 'rb')
+
+
+def index_fasta(fasta, path):
+    """
+    Writes the contigs of a plain or gzip compressed fasta file to an uncompressed fasta file with each sequence on one
+    line, and a faidx index of it at <path>.fai. The sequences are never all in memory, and load_contigs can then
+    memory-map the file and read only the parts of it that are sliced.
     :param fasta: string that contains the path to the fasta file to be used during alignment
-    :return: contigs: dictionary with format {'contig name' : 'sequence information'}
+    :param path: path of the uncompressed fasta file to write
+    :return: None
     """
     t = time.time()
-    contigs = {}
-    with open(fasta, 'r') as f:
-        sequence = f.read()
+    with metrics.stage('index_fasta') as record:
+        index = []
+        name = None
+        with open_fasta(fasta) as f, open(path, 'wb') as out:
+            offset = 0
+            for line in f:
+                if line.startswith(b'>'):
+                    if name is not None:
+                        out.write(b'\n')
+                        offset += 1
+                        index.append((name, length, start))
+                    name = line[1:].decode().strip()
+                    header = '>{}\n'.format(name).encode()
+                    out.write(header)
+                    offset += len(header)
+                    start = offset
+                    length = 0
+                elif name is not None:
+                    line = line.strip().upper()
+                    out.write(line)
+                    offset += len(line)
+                    length += len(line)
+            if name is not None:
+                out.write(b'\n')
+                index.append((name, length, start))
+        with open('{}.fai'.format(path), 'w') as fai:
+            for name, length, start in index:
+                # NAME LENGTH OFFSET LINEBASES LINEWIDTH, with the whole sequence on one line
+                fai.write('{}\t{}\t{}\t{}\t{}\n'.format(name, length, start, length, length + 1))
+        record.update({'contigs': len(index), 'bases': sum(length for name, length, start in index)})
+    print('Finished indexing contigs, took: {}'.format(time.time()-t))
 
-    split_contigs = sequence.split('>')
-    del sequence
-    del split_contigs[0]
 
-    for contig in split_contigs:
-        content = contig.split("\n", 1)
-        contigs[content[0].strip()] = content[1].replace("\n", "").upper()
-    temp_reverse = {}
-    for contig in contigs:
-        temp_reverse['{}_reverse'.format(contig)] = contigs[contig][::-1]
-    contigs.update(temp_reverse)
-    print('Finished obtaining contigs, took: {}'.format(time.time()-t))
-    return contigs
+def load_contigs(path):
+    """
+    Memory-maps a fasta file written by index_fasta into a SequenceStore, using its faidx index
+    :param path: path of the fasta file written by index_fasta
+    :return: contigs: SequenceStore that can be used as a dictionary with format {'contig name' : 'sequence information'}
+    """
+    offsets = {}
+    with open('{}.fai'.format(path)) as fai:
+        for line in fai:
+            fields = line.rstrip('\n').split('\t')
+            offsets[fields[0]] = (int(fields[2]), int(fields[1]))
+    return SequenceStore(np.memmap(path, dtype=np.uint8, mode='r'), offsets)
 
 
 def get_reverse_complement(string):
@@ -46,23 +173,202 @@ def get_reverse_complement(string):
             print("Enzyme site incorrect. Please try again.")
     return reverse_complement
 
-def get_recognition_site(contigs, enzyme_site):
+def find_sites(sequence, site_list):
+    """
+    Finds the 1-based start of every (possibly overlapping) occurrence of any of the given sites in one sequence
+    :param sequence: String that contains the DNA sequence to scan
+    :param site_list: List of unique DNA sequences to look for
+    :return: Ordered list of site locations
+    """
+    sites = []
+    for site in site_list:
+        i = sequence.find(site)
+        while i != -1:
+            sites.append(i + 1)
+            i = sequence.find(site, i + 1)
+    if len(site_list) > 1:
+        sites = sorted(set(sites))
+    return sites
+
+
+def get_reverse_sites(sites, length, len_enzyme):
+    """
+    Mirrors the enzyme sites of a contig to its reverse complement. The site list contains each site and its reverse
+    complement, so a site that starts at p on the contig starts at length - p - len_enzyme + 2 on the reverse
+    complement.
+    :param sites: ordered list of enzyme site locations on the contig
+    :param length: length of the contig
+    :param len_enzyme: length of the enzyme site
+    :return: ordered list of enzyme site locations on the reverse complement
+    """
+    return [length - site - len_enzyme + 2 for site in reversed(sites)]
+
+
+def get_enzyme_sites(enzyme_site):
     """
-    Function that finds the positions of all enzyme recognition sites per fasta contig
+    Splits the enzyme argument into the recognition sites of each enzyme
+    :param enzyme_site: String with one or more comma-separated DNA sequences recognised by the Enzymes used in cmap
+        creation, e.g. 'GCTCTTC,CTTAAG' for a dual-enzyme cmap
+    :return: List of the recognition sites
+    """
+    return [site.strip() for site in enzyme_site.split(',') if site.strip()]
+
+
+def get_site_list(enzyme_site):
+    """
+    Makes the list of sequences to look for to find the sites of one enzyme on both strands
+    :param enzyme_site: String that contains the DNA sequence recognised by the Enzyme
+    :return: List with the enzyme site and, if it is not palindromic, its reverse complement
+    """
+    reverse_enzyme = get_reverse_complement(enzyme_site)
+    site_list = [enzyme_site]
+    if reverse_enzyme[::-1] != enzyme_site:
+        site_list.append(reverse_enzyme[::-1])
+    return site_list
+
+
+def find_enzyme_sites(sequence, enzyme_site_lists):
+    """
+    Finds the sites of every enzyme in one sequence, so each contig is sent to a worker once for all enzymes
+    :param sequence: String that contains the DNA sequence to scan
+    :param enzyme_site_lists: List with the output of get_site_list for each enzyme
+    :return: List with the ordered list of site locations of each enzyme
+    """
+    return [find_sites(sequence, site_list) for site_list in enzyme_site_lists]
+
+
+def iter_recognition_sites(contigs, enzyme_sites, n_threads=1):
+    """
+    Generator that finds the positions of the recognition sites of each enzyme per fasta contig, in the order of the
+    contigs. The workers scan the next forward contigs while the sites of the contigs before them are used, and at most
+    2 contigs per worker wait to be used. The sites of '<contig name>_reverse' are mirrored from the sites of the
+    contig.
     :param contigs: Dictionary with format {'contig name' : 'sequence information'}
-    :param enzyme_site: String that contains the DNA sequence recognised by the Enzyme used in cmap creation.
+    :param enzyme_sites: List of the DNA sequences recognised by the Enzymes used in cmap creation
+    :param n_threads: the number of threads that can be used for computation
+    :return: generator of tuples with format ('contig name', [ordered list of site locations of each enzyme])
+    """
+    enzyme_site_lists = [get_site_list(enzyme_site) for enzyme_site in enzyme_sites]
+    contig_names = list(contigs.keys())
+    forward_names = [seq for seq in contig_names
+                     if not (seq.endswith('_reverse') and seq[:-len('_reverse')] in contigs)]
+    is_forward = set(forward_names)
+    # the sites of a forward contig are kept until the contig and its '_reverse' are both yielded
+    uses = dict.fromkeys(forward_names, 1)
+    for seq in contig_names:
+        if seq not in is_forward:
+            uses[seq[:-len('_reverse')]] += 1
+    sites_temp = Parallel(n_jobs=int(n_threads), return_as='generator', pre_dispatch='2*n_jobs')(
+        delayed(find_enzyme_sites)(str(contigs[seq]), enzyme_site_lists) for seq in forward_names)
+    scanned = zip(forward_names, sites_temp)
+    forward_sites = {}
+    for seq in contig_names:
+        forward = seq if seq in is_forward else seq[:-len('_reverse')]
+        while forward not in forward_sites:
+            name, contig_sites = next(scanned)
+            forward_sites[name] = contig_sites
+        contig_sites = forward_sites[forward]
+        uses[forward] -= 1
+        if uses[forward] == 0:
+            del forward_sites[forward]
+        if seq in is_forward:
+            yield seq, contig_sites
+        else:
+            yield seq, [get_reverse_sites(sites, len(contigs[forward]), len(enzyme_site))
+                        for sites, enzyme_site in zip(contig_sites, enzyme_sites)]
+
+
+def combine_sites(enzyme_site_lists):
+    """
+    Combines the sites of several enzymes on one contig
+    :param enzyme_site_lists: List with the ordered list of site locations of each enzyme
+    :return: Ordered list of the site locations of all enzymes
+    """
+    if len(enzyme_site_lists) == 1:
+        return enzyme_site_lists[0]
+    return sorted(set(site for sites in enzyme_site_lists for site in sites))
+
+
+def get_recognition_sites(contigs, enzyme_sites, n_threads=1):
+    """
+    Function that finds the positions of the recognition sites of each enzyme per fasta contig in one pass over the
+    contigs. Only the forward contigs are scanned, the sites of '<contig name>_reverse' are mirrored from the sites of
+    the contig.
+    :param contigs: Dictionary with format {'contig name' : 'sequence information'}
+    :param enzyme_sites: List of the DNA sequences recognised by the Enzymes used in cmap creation
+    :param n_threads: the number of threads that can be used for computation
+    :return: Dictionary with format: {'enzyme site' : {'contig/cmap name' : [ordered list of enzyme site locations]}}
+    """
+    with metrics.stage('get_recognition_site', workers=int(n_threads), enzymes=len(enzyme_sites)) as record:
+        sites = {enzyme_site: {} for enzyme_site in enzyme_sites}
+        for seq, enzyme_site_lists in iter_recognition_sites(contigs, enzyme_sites, n_threads):
+            for enzyme_site, contig_sites in zip(enzyme_sites, enzyme_site_lists):
+                sites[enzyme_site][seq] = contig_sites
+        record.update({'contigs': len(contigs.keys()),
+                       'sites': sum(len(sites[enzyme_site][seq]) for enzyme_site in sites
+                                    for seq in sites[enzyme_site])})
+    return sites
+
+
+def get_recognition_site(contigs, enzyme_site, n_threads=1):
+    """
+    Function that finds the positions of all enzyme recognition sites per fasta contig. With several enzymes the sites
+    of all enzymes are combined, like the labels of all channels of the cmap.
+    :param contigs: Dictionary with format {'contig name' : 'sequence information'}
+    :param enzyme_site: String with one or more comma-separated DNA sequences recognised by the Enzymes used in cmap
+        creation.
+    :param n_threads: the number of threads that can be used for computation
     :return: Dictionary with format: {'contig/cmap name' : [ordered list of enzyme site locations]}
     """
     t = time.time()
+    enzyme_sites = get_enzyme_sites(enzyme_site)
+    sites_per_enzyme = get_recognition_sites(contigs, enzyme_sites, n_threads)
     sites = {}
-    len_enzyme = len(enzyme_site)
-    reverse_enzyme = get_reverse_complement(enzyme_site)
-    for seq in contigs:
-        sites[seq] = []
-        for i in range(len(contigs[seq])):
-            if contigs[seq][i:i + len_enzyme] == enzyme_site or contigs[seq][i:i + len_enzyme] == reverse_enzyme[::-1]:
-                sites[seq].append(i + 1)
+    for seq in contigs.keys():
+        sites[seq] = combine_sites([sites_per_enzyme[enzyme_site][seq] for enzyme_site in enzyme_sites])
     print("Finished get_recognition_sites, took: {}".format(time.time()-t))
     return sites
 
 
+def get_recognition_site_batches(contigs, enzyme_site, n_threads=1, batch_size=1000):
+    """
+    Generator that finds the positions of all enzyme recognition sites per fasta contig, like get_recognition_site, and
+    yields them per batch of contigs as soon as the batch is scanned, so the next stage can use a batch while the
+    workers scan the next ones
+    :param contigs: Dictionary with format {'contig name' : 'sequence information'}
+    :param enzyme_site: String with one or more comma-separated DNA sequences recognised by the Enzymes used in cmap
+        creation.
+    :param n_threads: the number of threads that can be used for computation
+    :param batch_size: number of contigs per batch
+    :return: generator of dictionaries with format: {'contig/cmap name' : [ordered list of enzyme site locations]}
+    The get_recognition_site stage is written to the metrics when the last batch is used. Its wall and CPU time only
+    count the time spent in this generator, not the time the next stage spends on the batches.
+    """
+    t = time.time()
+    enzyme_sites = get_enzyme_sites(enzyme_site)
+    record = {'workers': int(n_threads), 'enzymes': len(enzyme_sites), 'contigs': 0, 'sites': 0}
+    worker_cpu_start = metrics.get_worker_cpu_time()
+    rss_start = metrics.get_rss()
+    wall_time = 0.0
+    cpu_time = 0.0
+    wall_start = time.time()
+    cpu_start = time.process_time()
+    batch = {}
+    for seq, enzyme_site_lists in iter_recognition_sites(contigs, enzyme_sites, n_threads):
+        batch[seq] = combine_sites(enzyme_site_lists)
+        record['contigs'] += 1
+        record['sites'] += len(batch[seq])
+        if len(batch) == batch_size:
+            wall_time += time.time() - wall_start
+            cpu_time += time.process_time() - cpu_start
+            yield batch
+            wall_start = time.time()
+            cpu_start = time.process_time()
+            batch = {}
+    wall_time += time.time() - wall_start
+    cpu_time += time.process_time() - cpu_start
+    if batch:
+        yield batch
+    metrics.write_stage('get_recognition_site', wall_time, cpu_time,
+                        metrics.get_worker_cpu_time() - worker_cpu_start, record, rss_start)
+    print("Finished get_recognition_sites, took: {}".format(time.time()-t))
@@ -1,20 +1,14 @@
-import sqlite3
-def remove_fasta(remove_fa_list, db_name):
-    connection = sqlite3.connect("{}.db".format(db_name))
-    cursor = connection.cursor()
+import storage
+import metrics
 
-    remove_cmd = """
-        DELETE FROM fasta
-        WHERE contig=? AND pos_contig=?"""
-    cursor.executemany(remove_cmd,remove_fa_list)
-    connection.commit()
 
-def remove_cmap(remove_cmap_list, db_name):
-    connection = sqlite3.connect("{}.db".format(db_name))
-    cursor = connection.cursor()
+def remove_fasta(remove_fa_list, db_name, storage_type='sqlite'):
+    backend = storage.get_backend(storage_type)
+    with metrics.stage('remove_pos', table='fasta', rows=len(remove_fa_list)):
+        backend.remove_kmers(db_name, 'fasta', remove_fa_list)
 
-    remove_cmd = """
-            DELETE FROM cmap
-            WHERE contig=? AND pos_contig=?"""
-    cursor.executemany(remove_cmd, remove_cmap_list)
-    connection.commit()
+
+def remove_cmap(remove_cmap_list, db_name, storage_type='sqlite'):
+    backend = storage.get_backend(storage_type)
+    with metrics.stage('remove_pos', table='cmap', rows=len(remove_cmap_list)):
+        backend.remove_kmers(db_name, 'cmap', remove_cmap_list)
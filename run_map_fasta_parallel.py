@@ -1,31 +1,33 @@
-import sqlite3
 import time
 from joblib import Parallel, delayed
 import sys
 import numpy as np
 import functions_map_fasta_parallel as r
+import shared_arrays as sa
+import metrics
 
 
-def parallel_init_cmap_dict(cmap_list, np_positions_cmap, np_name_id_cmap, cmap_pos_dict, n_threads):
+def parallel_init_cmap_dict(cmap_list, np_positions_cmap, position_index_cmap, cmap_pos_dict, n_threads):
     """
     Call the init_cmap_dict function in parallel
     :param cmap_list: List of all cmap names
     :param np_positions_cmap: numpy array with format [[pos_1 pos_2 pos_3 ... pos_n]]. The array has 1 row per k-mer
         per cmap
-    :param np_name_id_cmap: numpy array with format [[cmap_name position_id]] with a row per cmap and position_id
+    :param position_index_cmap: dictionary with format {cmap_name:row of position_id 1 in np_positions_cmap}
     :param cmap_pos_dict: dictionary with format {cmap_name:[list of all position_ids in this cmap]}
     :param n_threads: the number of threads that can be used for computation
     :return: a list with format [[cmap_name, {cmap_location:False}, [sorted_locations]]]
     """
     cmap_temp = Parallel(n_jobs=int(n_threads))(
-        delayed(r.init_cmap_dict)(cmap_name, np_positions_cmap, np_name_id_cmap, cmap_pos_dict[cmap_name]) for cmap_name
-        in cmap_list)
+        delayed(r.init_cmap_dict)(cmap_name, np_positions_cmap, position_index_cmap, cmap_pos_dict[cmap_name])
+        for cmap_name in cmap_list)
 
     return cmap_temp
 
 
-def get_mapping_pos_fasta(min_kmer_consecutive, fasta_list, db_name, n_threads, np_positions_fasta, np_name_id_fasta,
-                          np_positions_cmap, np_name_id_cmap):
+def get_mapping_pos_fasta(min_kmer_consecutive, fasta_list, db_name, n_threads, np_positions_fasta,
+                          position_index_fasta, np_positions_cmap, position_index_cmap, storage_type,
+                          max_deviation=None):
     """
     Run get_mapping_location_fasta in parallel
     :param min_kmer_consecutive: The minimum number of consecutive overlapping k-mers for an overlap to be considered
@@ -34,100 +36,158 @@ def get_mapping_pos_fasta(min_kmer_consecutive, fasta_list, db_name, n_threads,
     :param n_threads: the number of threads that can be used for computation
     :param np_positions_fasta: numpy array with format [[pos_1 pos_2 pos_3 ... pos_n]]. The array has 1 row per k-mer
         per fasta
-    :param np_name_id_fasta: numpy array with format [[fasta_name position_id]] with a row per fasta and position_id
+    :param position_index_fasta: dictionary with format {fasta_name:row of position_id 1 in np_positions_fasta}
     :param np_positions_cmap: numpy array with format [[pos_1 pos_2 pos_3 ... pos_n]]. The array has 1 row per k-mer
         per cmap
-    :param np_name_id_cmap: numpy array with format [[cmap_name position_id]] with a row per cmap and position_id
+    :param position_index_cmap: dictionary with format {cmap_name:row of position_id 1 in np_positions_cmap}
+    :param storage_type: sqlite or columnar
+    :param max_deviation: if given, only use the overlaps with at most this deviation of which neither k-mer has been
+        removed
     :return: list with format [[{cmap_name:{"cmap_start:cmap_stop":["fasta_start:fasta_stop", fasta_name]}},
     remove_fasta, remove_cmap]]
     """
+    # Each task only needs the index entry of its own fasta contig
     mapped_fasta_temp = Parallel(n_jobs=int(n_threads))(
         delayed(r.get_mapping_location_fasta)(fasta, int(min_kmer_consecutive), db_name, np_positions_cmap,
-                                              np_name_id_cmap, np_positions_fasta,
-                                              np_name_id_fasta) for fasta in fasta_list)
+                                              position_index_cmap, np_positions_fasta,
+                                              {fasta: position_index_fasta.get(fasta)}, storage_type, max_deviation)
+        for fasta in fasta_list)
     return mapped_fasta_temp
 
 
-def get_all_mapping_info(db_name, cmap_list, min_kmer_consecutive, fasta_list, n_threads):
+def get_empty_cmap_info(db_name, cmap_list, n_threads, storage_type, np_positions_cmap, position_index_cmap):
     """
-    Function to obtain all mapping information, of which sequence regions overlap with which cmap regions
+    Function to obtain the cmap locations that fasta regions can be mapped to
     :param db_name: name of the database
     :param cmap_list: list of all the cmaps used
-    :param min_kmer_consecutive: The minimum number of consecutive overlapping k-mers for an overlap to be considered
-    :param fasta_list: list of all the fasta contigs
-    :param n_threads:
-    :return: the number of threads that can be used for computation
+    :param n_threads: the number of threads that can be used for computation
+    :param storage_type: sqlite or columnar
+    :param np_positions_cmap: memory-mapped numpy array with format [[pos_1 pos_2 pos_3 ... pos_n]]. The array has 1
+        row per k-mer per cmap
+    :param position_index_cmap: dictionary with format {cmap_name:row of position_id 1 in np_positions_cmap}
+    :return: empty_cmap_dict: dictionary with format {cmap_name:{"cmap_start:cmap_stop":[]}}
+    :return: sorted_pos_cmap_lict: dictionary with format {cmap_name:[sorted cmap locations]}
     """
-    connection = sqlite3.connect("{}.db".format(db_name))
-    cursor = connection.cursor()
-
-    np_positions_fasta, np_name_id_fasta = r.get_positions('fasta', cursor)
-    np_positions_cmap, np_name_id_cmap = r.get_positions('cmap', cursor)
-
-    cmap_pos_dict = r.get_cmap_pos_dict(cmap_list, cursor)
+    cmap_pos_dict = r.get_cmap_pos_dict(cmap_list, db_name, storage_type)
 
-    init_cmap_dict = parallel_init_cmap_dict(cmap_list, np_positions_cmap, np_name_id_cmap, cmap_pos_dict, n_threads)
+    init_cmap_dict = parallel_init_cmap_dict(cmap_list, np_positions_cmap, position_index_cmap, cmap_pos_dict,
+                                             n_threads)
     del cmap_pos_dict
     empty_cmap_dict, sorted_pos_cmap_lict = r.get_empty_cmap_dict(init_cmap_dict)
     del init_cmap_dict
+    return empty_cmap_dict, sorted_pos_cmap_lict
 
-    mapped_fasta_temp = get_mapping_pos_fasta(min_kmer_consecutive, fasta_list, db_name, n_threads,
-                                              np_positions_fasta, np_name_id_fasta, np_positions_cmap, np_name_id_cmap)
-    del np_positions_fasta
-    del np_name_id_fasta
-    del np_positions_cmap
-    del np_name_id_cmap
+
+def get_fasta_mapping_info(db_name, min_kmer_consecutive, fasta_list, n_threads, storage_type, max_deviation=None,
+                           np_positions_cmap=None, position_index_cmap=None):
+    """
+    Function to obtain the mapping information of each fasta contig, before the mappings of the contigs are combined
+    :param db_name: name of the database
+    :param min_kmer_consecutive: The minimum number of consecutive overlapping k-mers for an overlap to be considered
+    :param fasta_list: list of the fasta contigs to map
+    :param n_threads: the number of threads that can be used for computation
+    :param storage_type: sqlite or columnar
+    :param max_deviation: if given, only use the overlaps with at most this deviation of which neither k-mer has been
+        removed
+    :param np_positions_cmap: if given, the cmap positions as returned by get_positions, which are then not read again
+    :param position_index_cmap: if given, the index of np_positions_cmap as returned by get_positions
+    :return: list with format [[{cmap_name:{"cmap_start:cmap_stop":["fasta_start:fasta_stop", fasta_name]}},
+    remove_fasta, remove_cmap]], 1 item per contig in fasta_list
+    """
+    np_positions_fasta, position_index_fasta = r.get_positions('fasta', db_name, storage_type)
+    if np_positions_cmap is None:
+        np_positions_cmap, position_index_cmap = r.get_positions('cmap', db_name, storage_type)
+    # The position arrays are read by every task, so they are memory-mapped once instead of sent with each task
+    shared_dir = sa.make_shared_dir(db_name)
+    try:
+        np_positions_fasta = sa.share_array(shared_dir, 'np_positions_fasta', np_positions_fasta)
+        np_positions_cmap = sa.share_array(shared_dir, 'np_positions_cmap', np_positions_cmap)
+
+        mapped_fasta_temp = get_mapping_pos_fasta(min_kmer_consecutive, fasta_list, db_name, n_threads,
+                                                  np_positions_fasta, position_index_fasta, np_positions_cmap,
+                                                  position_index_cmap, storage_type, max_deviation)
+    finally:
+        del np_positions_fasta
+        del position_index_fasta
+        del np_positions_cmap
+        del position_index_cmap
+        sa.remove_shared_dir(shared_dir)
+    return mapped_fasta_temp
+
+
+def get_all_mapping_info(db_name, cmap_list, min_kmer_consecutive, fasta_list, n_threads, storage_type,
+                         max_deviation=None, mapped_fasta_temp=None):
+    """
+    Function to obtain all mapping information, of which sequence regions overlap with which cmap regions
+    :param db_name: name of the database
+    :param cmap_list: list of all the cmaps used
+    :param min_kmer_consecutive: The minimum number of consecutive overlapping k-mers for an overlap to be considered
+    :param fasta_list: list of all the fasta contigs
+    :param n_threads:
+    :param storage_type: sqlite or columnar
+    :param max_deviation: if given, only use the overlaps with at most this deviation of which neither k-mer has been
+        removed
+    :param mapped_fasta_temp: if given, the output of get_fasta_mapping_info for all contigs in fasta_list, e.g.
+        combined from the shards of a sharded run, which is used instead of mapping the contigs again
+    :return: the number of threads that can be used for computation
+    """
+    np_positions_cmap, position_index_cmap = r.get_positions('cmap', db_name, storage_type)
+    # The cmap positions are read by the tasks of both steps, so they are read and memory-mapped once
+    shared_dir = sa.make_shared_dir(db_name)
+    try:
+        np_positions_cmap = sa.share_array(shared_dir, 'np_positions_cmap', np_positions_cmap)
+        empty_cmap_dict, sorted_pos_cmap_lict = get_empty_cmap_info(db_name, cmap_list, n_threads, storage_type,
+                                                                    np_positions_cmap, position_index_cmap)
+        if mapped_fasta_temp is None:
+            mapped_fasta_temp = get_fasta_mapping_info(db_name, min_kmer_consecutive, fasta_list, n_threads,
+                                                       storage_type, max_deviation, np_positions_cmap,
+                                                       position_index_cmap)
+    finally:
+        del np_positions_cmap
+        sa.remove_shared_dir(shared_dir)
 
     filled_cmap_dict, remove_fasta, remove_cmap = r.enter_info_cmap_dict(mapped_fasta_temp, empty_cmap_dict)
 
     return filled_cmap_dict, sorted_pos_cmap_lict, remove_fasta, remove_cmap
 
 
-def merge(db_name, enzyme_sequence, fasta_sequence_dict, min_kmer_consecutive, n_threads, all_seq={}):
+def merge(db_name, enzyme_sequence, fasta_sequence_dict, min_kmer_consecutive, n_threads, all_seq={},
+          storage_type='sqlite', max_deviation=None, mapped_fasta_temp=None):
     print("started merging")
     t = time.time()
     mapped_pos_number = 0
 
     fasta_list = list(fasta_sequence_dict.keys())
-    cmap_list = r.get_cmap_list(db_name)
-
-    cmap_mapping, sorted_pos, remove_fasta, remove_cmap = get_all_mapping_info(db_name, cmap_list,
-                                                                                 min_kmer_consecutive,
-                                                                                 fasta_list, n_threads)
+    cmap_list = r.get_cmap_list(db_name, storage_type)
+
+    with metrics.stage('get_all_mapping_info', workers=int(n_threads), min_kmer_consecutive=int(min_kmer_consecutive),
+                       max_deviation=max_deviation) as record:
+        cmap_mapping, sorted_pos, remove_fasta, remove_cmap = get_all_mapping_info(db_name, cmap_list,
+                                                                                     min_kmer_consecutive,
+                                                                                     fasta_list, n_threads,
+                                                                                     storage_type, max_deviation,
+                                                                                     mapped_fasta_temp)
+        record.update({'fasta_contigs': len(fasta_list), 'cmaps': len(cmap_list), 'removed_fasta': len(remove_fasta),
+                       'removed_cmap': len(remove_cmap)})
     print('getting all overlaps took: {}'.format(time.time()-t))
     for cmap in cmap_list:
         if cmap not in all_seq:
-            all_seq[cmap] = ''
-
-    sequences_temp = Parallel(n_jobs=int(n_threads))(
-        delayed(r.merge_fa_cmap)(cmap_mapping, cmap, sorted_pos[cmap], enzyme_sequence, fasta_sequence_dict, all_seq[cmap])
-        for cmap in cmap_list)
-
-    for item in sequences_temp:
-        all_seq[item[0]] = item[1]
-        mapped_pos_number += item[2]
+            all_seq[cmap] = bytearray()
+
+    with metrics.stage('merge_fa_cmap', workers=int(n_threads)) as record:
+        # Each task only needs the mapping of its own cmap and the offsets of the fasta contigs mapped to it, the
+        # sequence buffer itself is memory-mapped
+        sequences_temp = Parallel(n_jobs=int(n_threads))(
+            delayed(r.merge_fa_cmap)({cmap: cmap_mapping[cmap]}, cmap, sorted_pos[cmap], enzyme_sequence,
+                                     fasta_sequence_dict.subset(mapping[1] for mapping in cmap_mapping[cmap].values()
+                                                                if mapping),
+                                     all_seq[cmap])
+            for cmap in cmap_list)
+
+        for item in sequences_temp:
+            all_seq[item[0]] = item[1]
+            mapped_pos_number += item[2]
+        record.update({'cmaps': len(cmap_list), 'mapped_positions': mapped_pos_number,
+                       'bases': sum(len(all_seq[cmap]) for cmap in cmap_list)})
     print("everything together took: {}".format(time.time() - t))
     return all_seq, remove_fasta, remove_cmap, mapped_pos_number
-
-
-def get_contigs(fasta):
-    t = time.time()
-    contigs = {}
-    with open(fasta, 'r') as f:
-        sequence = f.read()
-
-    split_contigs = sequence.split('>')
-    del sequence
-    del split_contigs[0]
-
-    for contig in split_contigs:
-        content = contig.split("\n", 1)
-        contigs[content[0].strip()] = content[1].replace("\n", "").upper()
-    temp_reverse = {}
-    for contig in contigs:
-        temp_reverse['{}_reverse'.format(contig)] = contigs[contig][::-1]
-    contigs.update(temp_reverse)
-    print('Finished obtaining contigs, took: {}'.format(time.time()-t))
-    return contigs
-
-
@@ -1,9 +1,17 @@
-from setuptools import setup
+from setuptools import setup, Extension
 #from distutils.core import setup
 from Cython.Build import cythonize
 
 import numpy
 
+# The typed kernels split their loops over threads with OpenMP. They are optional, so with a compiler without OpenMP
+# the other modules are still built and the NumPy code is used instead. cythonize does not copy the optional flag to
+# the extensions it returns, so it is set on these.
+kernels = cythonize([Extension("overlap_kernels", ["overlap_kernels.pyx"], include_dirs=[numpy.get_include()],
+                               extra_compile_args=["-fopenmp"], extra_link_args=["-fopenmp"])])
+for extension in kernels:
+    extension.optional = True
+
 setup(
     name = 'hybrid assembler',
     version = '1.2.2',
@@ -11,6 +19,6 @@ setup(
     url = "https://github.com/Esmeetbdb/Hybrid_Assembly",
     author = "Esmee ten Berk de Boer",
 
-    ext_modules = cythonize(["process_fasta.py", "find_overlaps_np_parallel.pyx", "functions_map_fasta_parallel.pyx"]),
+    ext_modules = cythonize(["process_fasta.py", "find_overlaps_np_parallel.pyx", "functions_map_fasta_parallel.pyx"]) + kernels,
     include_dirs=[numpy.get_include()]
 )
@@ -0,0 +1,145 @@
+import glob
+import json
+import os
+import pickle
+
+# A sharded run splits the overlap search and the mapping of the fasta contigs of each round over independent jobs,
+# which can run on different nodes that share a filesystem. The prepare step makes the index and writes
+# <prefix>.manifest.json with the fasta contigs of each shard. Each shard job searches and maps its own contigs on a copy
+# of the index and writes the result to <prefix>.round<round>.shard<shard>.pkl. The merge step then combines the shard
+# results in the order of the fasta file, so the longest alignment wins the same way as in a run that is not sharded,
+# removes the mapped k-mers from the index and moves the run to the next round.
+
+
+def get_manifest_path(prefix):
+    """
+    Returns the path of the manifest of a sharded run
+    :param prefix: prefix of the run
+    :return: path to the manifest file
+    """
+    return "{}.manifest.json".format(prefix)
+
+
+def write_manifest(prefix, manifest):
+    """
+    Writes the manifest of a sharded run. The file is replaced in one step, so shard jobs never read half of it.
+    :param prefix: prefix of the run
+    :param manifest: dictionary with the input files, settings, shards and current round of the run
+    :return: None
+    """
+    path = get_manifest_path(prefix)
+    with open("{}.tmp".format(path), 'w') as file:
+        json.dump(manifest, file, indent=1)
+    os.replace("{}.tmp".format(path), path)
+
+
+def read_manifest(prefix):
+    """
+    Reads the manifest of a sharded run
+    :param prefix: prefix of the run
+    :return: dictionary stored by write_manifest
+    """
+    path = get_manifest_path(prefix)
+    if not os.path.exists(path):
+        raise ValueError("No sharded run with prefix {}, run the prepare step first".format(prefix))
+    with open(path) as file:
+        return json.load(file)
+
+
+def split_contigs(contigs, n_shards):
+    """
+    Splits the fasta contigs into ranges of about the same number of bases. A contig and its '<contig name>_reverse'
+    are always in the same shard.
+    :param contigs: dictionary with format {'contig name' : sequence}
+    :param n_shards: number of shards
+    :return: list with format [[contig names of the shard]], 1 list per shard, with the names in the order of contigs
+    """
+    names = list(contigs.keys())
+    forward = [name for name in names if not (name.endswith('_reverse') and name[:-len('_reverse')] in contigs)]
+    total = max(sum(len(contigs[name]) for name in forward), 1)
+    shard_of = {}
+    done = 0
+    for name in forward:
+        shard_of[name] = min(done * n_shards // total, n_shards - 1)
+        shard_of['{}_reverse'.format(name)] = shard_of[name]
+        done += len(contigs[name])
+    shards = [[] for i in range(n_shards)]
+    for name in names:
+        shards[shard_of[name]].append(name)
+    return shards
+
+
+def get_shard_db_name(prefix, shard):
+    """
+    Returns the name of the copy of the index a shard job works on
+    :param prefix: prefix of the run
+    :param shard: number of the shard
+    :return: name of the database of the shard
+    """
+    return "{}.shard{}".format(prefix, shard)
+
+
+def get_shard_path(prefix, round_number, shard):
+    """
+    Returns the path of the result of a shard job
+    :param prefix: prefix of the run
+    :param round_number: round of the result
+    :param shard: number of the shard
+    :return: path to the result file
+    """
+    return "{}.round{}.shard{}.pkl".format(prefix, round_number, shard)
+
+
+def save_shard_result(prefix, manifest, shard, mapped_fasta_dict):
+    """
+    Stores the mapping of the contigs of a shard in the current round. The file is replaced in one step, so the merge
+    step never reads the result of a shard job that is still writing.
+    :param prefix: prefix of the run
+    :param manifest: dictionary stored by write_manifest
+    :param shard: number of the shard
+    :param mapped_fasta_dict: dictionary with format {fasta_name: output of get_mapping_location_fasta}
+    :return: None
+    """
+    result = {'index': manifest['index'],
+              'round': manifest['round'],
+              'mapped_fasta_dict': mapped_fasta_dict}
+    path = get_shard_path(prefix, manifest['round'], shard)
+    with open("{}.tmp".format(path), 'wb') as file:
+        pickle.dump(result, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace("{}.tmp".format(path), path)
+
+
+def load_shard_results(prefix, manifest):
+    """
+    Reads the results of all shards of the current round and combines them in the order of the fasta file
+    :param prefix: prefix of the run
+    :param manifest: dictionary stored by write_manifest
+    :return: list with format [[{cmap_name:{"cmap_start:cmap_stop":["fasta_start:fasta_stop", fasta_name]}},
+    remove_fasta, remove_cmap]], 1 item per fasta contig
+    """
+    missing = [shard for shard in range(manifest['n_shards'])
+               if not os.path.exists(get_shard_path(prefix, manifest['round'], shard))]
+    if missing:
+        raise ValueError("Missing the results of round {} of shards: {}".format(
+            manifest['round'], ', '.join(str(shard) for shard in missing)))
+
+    mapped_fasta_dict = {}
+    for shard in range(manifest['n_shards']):
+        with open(get_shard_path(prefix, manifest['round'], shard), 'rb') as file:
+            result = pickle.load(file)
+        if result['index'] != manifest['index'] or result['round'] != manifest['round']:
+            raise ValueError("The result of shard {} was made for another run or round".format(shard))
+        mapped_fasta_dict.update(result['mapped_fasta_dict'])
+    return [mapped_fasta_dict[fasta] for fasta in manifest['fasta_list']]
+
+
+def remove_shard_results(prefix, round_number=None):
+    """
+    Removes the results of the shard jobs
+    :param prefix: prefix of the run
+    :param round_number: round of the results to remove, or None to remove the results of all rounds
+    :return: None
+    """
+    pattern = "round{}".format(round_number) if round_number is not None else "round*"
+    for path in glob.glob("{}.{}.shard*.pkl*".format(glob.escape(prefix), pattern)):
+        os.remove(path)
@@ -0,0 +1,55 @@
+import glob
+import os
+import shutil
+import tempfile
+import numpy as np
+
+# joblib sends a read-only np.memmap to its workers as a reference to the file instead of pickling the content, so
+# arrays that every task needs are written once to a .npy file and memory-mapped. The workers then read the same pages
+# from the page cache instead of getting their own copy.
+
+
+def make_shared_dir(db_name):
+    """
+    Creates a new directory next to the database for the memory-mapped arrays of one stage
+    :param db_name: name of the database
+    :return: path to the directory
+    """
+    directory = os.path.dirname(os.path.abspath(db_name))
+    return tempfile.mkdtemp(prefix="{}_shared_".format(os.path.basename(db_name)), dir=directory)
+
+
+def share_array(directory, name, array):
+    """
+    Writes an array to a .npy file in the shared directory and memory-maps it read-only. Arrays that are already
+    read-only memory-mapped files are returned as they are.
+    :param directory: directory made by make_shared_dir
+    :param name: name of the array, used as file name
+    :param array: numpy array to share with the workers
+    :return: read-only numpy memmap with the content of array
+    """
+    if isinstance(array, np.memmap) and array.mode == 'r':
+        return array
+    path = os.path.join(directory, "{}.npy".format(name))
+    np.save(path, np.ascontiguousarray(array))
+    return np.load(path, mmap_mode='r')
+
+
+def remove_shared_dir(directory):
+    """
+    Removes the shared directory and the arrays in it. Arrays that are still memory-mapped stay readable until they
+    are closed.
+    :param directory: directory made by make_shared_dir
+    :return: None
+    """
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def remove_old_shared_dirs(db_name):
+    """
+    Removes the shared directories that a stopped run with the same prefix left behind
+    :param db_name: name of the database
+    :return: None
+    """
+    for directory in glob.glob("{}_shared_*".format(glob.escape(os.path.abspath(db_name)))):
+        remove_shared_dir(directory)
@@ -0,0 +1,245 @@
+import argparse
+import re
+import sys
+import numpy as np
+
+# Simulates the input of a run with a known answer: a random genome, long reads sampled from it with sequencing
+# errors, and a cmap with a map per genome segment whose labels are the enzyme sites with gaussian jitter. The true
+# location of every read and map is written to <prefix>.truth.tsv.
+
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+COMPLEMENT = bytes.maketrans(b'ACGTN', b'TGCAN')
+
+
+def random_genome(rng, n_chromosomes, genome_size):
+    """
+    Generates random chromosomes of equal length
+    :param rng: numpy random Generator
+    :param n_chromosomes: number of chromosomes
+    :param genome_size: total length of the chromosomes
+    :return: dictionary with format {'chromosome name' : sequence bytes}
+    """
+    genome = {}
+    length = genome_size // n_chromosomes
+    for i in range(n_chromosomes):
+        genome['chr{}'.format(i + 1)] = BASES[rng.integers(0, 4, length)].tobytes()
+    return genome
+
+
+def get_reverse_complement(sequence):
+    """
+    Makes the reverse complement of a DNA sequence
+    :param sequence: DNA sequence as bytes
+    :return: reverse complement of the sequence as bytes
+    """
+    return sequence.translate(COMPLEMENT)[::-1]
+
+
+def find_enzyme_sites(sequence, enzyme_site):
+    """
+    Finds the 1-based start of every enzyme site on either strand, the same way sites are reported for a fasta contig
+    :param sequence: DNA sequence as bytes
+    :param enzyme_site: recognition site of the enzyme, or comma-separated sites of several enzymes
+    :return: ordered list of enzyme site locations
+    """
+    sites = set()
+    for site in enzyme_site.split(','):
+        sites.update([site.encode(), get_reverse_complement(site.encode())])
+    pattern = re.compile(b'(?=' + b'|'.join(re.escape(site) for site in sites) + b')')
+    return [match.start() + 1 for match in pattern.finditer(sequence)]
+
+
+def add_errors(rng, sequence, error_rate):
+    """
+    Adds substitutions, insertions and deletions to a sequence, each at a third of the error rate
+    :param rng: numpy random Generator
+    :param sequence: DNA sequence as bytes
+    :param error_rate: probability of an error at each base
+    :return: sequence with errors as bytes
+    """
+    read = np.frombuffer(sequence, dtype=np.uint8).copy()
+    error = rng.random(len(read))
+    substitution = error < error_rate / 3
+    read[substitution] = BASES[rng.integers(0, 4, int(substitution.sum()))]
+    insertion = np.nonzero((error >= error_rate / 3) & (error < 2 * error_rate / 3))[0]
+    keep = ~((error >= 2 * error_rate / 3) & (error < error_rate))
+    inserted = np.insert(read, insertion + 1, BASES[rng.integers(0, 4, len(insertion))])
+    keep = np.insert(keep, insertion + 1, True)
+    return inserted[keep].tobytes()
+
+
+def simulate_reads(rng, genome, coverage, min_length, max_length, error_rate):
+    """
+    Samples reads uniformly from the genome until the coverage is reached. Half of the reads are reverse complemented.
+    :param rng: numpy random Generator
+    :param genome: dictionary with format {'chromosome name' : sequence bytes}
+    :param coverage: mean number of reads covering each base
+    :param min_length: minimum read length
+    :param max_length: maximum read length
+    :param error_rate: probability of an error at each base
+    :return: reads: dictionary with format {'read name' : sequence bytes}
+    :return: truth: list with format [['read', read name, chromosome, start, end, strand]], start is 0-based
+    """
+    reads = {}
+    truth = []
+    names = list(genome)
+    lengths = np.array([len(genome[name]) for name in names])
+    n_bases = coverage * lengths.sum()
+    sampled = 0
+    while sampled < n_bases:
+        chromosome = names[rng.choice(len(names), p=lengths / lengths.sum())]
+        length = int(min(rng.integers(min_length, max_length + 1), len(genome[chromosome])))
+        start = int(rng.integers(0, len(genome[chromosome]) - length + 1))
+        sequence = genome[chromosome][start:start + length]
+        strand = '+'
+        if rng.random() < 0.5:
+            sequence = get_reverse_complement(sequence)
+            strand = '-'
+        name = 'read{}'.format(len(reads) + 1)
+        reads[name] = add_errors(rng, sequence, error_rate)
+        truth.append(['read', name, chromosome, start, start + length, strand])
+        sampled += length
+    return reads, truth
+
+
+def simulate_cmap(rng, genome, enzyme_site, map_length, jitter):
+    """
+    Makes a map for each segment of map_length of each chromosome, with the enzyme sites as labels
+    :param rng: numpy random Generator
+    :param genome: dictionary with format {'chromosome name' : sequence bytes}
+    :param enzyme_site: recognition site of the enzyme
+    :param map_length: length of the genome segment of each map
+    :param jitter: standard deviation of the gaussian error added to each label position
+    :return: maps: list with format [[map id, map length, [label positions]]]
+    :return: truth: list with format [['map', map id, chromosome, start, end, '+']], start is 0-based
+    """
+    maps = []
+    truth = []
+    for chromosome in genome:
+        sites = np.array(find_enzyme_sites(genome[chromosome], enzyme_site), dtype=np.int64)
+        for start in range(0, len(genome[chromosome]), map_length):
+            end = min(start + map_length, len(genome[chromosome]))
+            labels = sites[(sites > start) & (sites <= end)] - start
+            labels = labels + np.rint(rng.normal(0, jitter, len(labels))).astype(np.int64)
+            labels = np.sort(np.clip(labels, 1, end - start))
+            maps.append([len(maps) + 1, end - start, labels.tolist()])
+            truth.append(['map', len(maps), chromosome, start, end, '+'])
+    return maps, truth
+
+
+def write_fasta(path, sequences, line_length=80):
+    """
+    Writes sequences to a fasta file
+    :param path: path to the fasta file
+    :param sequences: dictionary with format {'name' : sequence bytes}
+    :param line_length: number of bases per line
+    :return: None
+    """
+    with open(path, 'wb') as file:
+        for name in sequences:
+            file.write('>{}\n'.format(name).encode())
+            for i in range(0, len(sequences[name]), line_length):
+                file.write(sequences[name][i:i + line_length] + b'\n')
+
+
+def write_cmap(path, maps):
+    """
+    Writes the maps in the CMAP 0.2 format. Like a real cmap, each map ends with a line in label channel 0 at the end of
+    the map.
+    :param path: path to the cmap file
+    :param maps: list with format [[map id, map length, [label positions]]]
+    :return: None
+    """
+    with open(path, 'w') as file:
+        file.write('# CMAP File Version:\t0.2\n')
+        file.write('#h CMapId\tContigLength\tNumSites\tSiteID\tLabelChannel\tPosition\tStdDev\tCoverage\tOccurrence\n')
+        for map_id, length, labels in maps:
+            for i, position in enumerate(labels):
+                file.write('{}\t{:.1f}\t{}\t{}\t1\t{:.1f}\t1.0\t1\t1\n'.format(map_id, float(length), len(labels), i + 1,
+                                                                             float(position)))
+            file.write('{}\t{:.1f}\t{}\t{}\t0\t{:.1f}\t0.0\t1\t0\n'.format(map_id, float(length), len(labels),
+                                                                         len(labels) + 1, float(length)))
+
+
+def write_truth(path, truth):
+    """
+    Writes the true location of each map and read
+    :param path: path to the truth file
+    :param truth: list with format [[type, name, chromosome, start, end, strand]]
+    :return: None
+    """
+    with open(path, 'w') as file:
+        file.write('type\tname\tchromosome\tstart\tend\tstrand\n')
+        for row in truth:
+            file.write('\t'.join(str(value) for value in row) + '\n')
+
+
+def read_truth(path):
+    """
+    Reads the true location of each map and read
+    :param path: path to a truth file written by write_truth
+    :return: list with format [[type, name, chromosome, start, end, strand]]
+    """
+    truth = []
+    with open(path) as file:
+        next(file)
+        for line in file:
+            row = line.rstrip('\n').split('\t')
+            truth.append([row[0], row[1], row[2], int(row[3]), int(row[4]), row[5]])
+    return truth
+
+
+def simulate(prefix, genome_size, n_chromosomes=1, coverage=10, min_length=40000, max_length=90000, error_rate=0.0,
+             enzyme_site='CTTAAG', map_length=500000, jitter=200, seed=1):
+    """
+    Writes <prefix>.genome.fa, <prefix>.reads.fa, <prefix>.cmap and <prefix>.truth.tsv
+    :param prefix: prefix of the output files
+    :param genome_size: total length of the genome
+    :param n_chromosomes: number of chromosomes
+    :param coverage: mean number of reads covering each base
+    :param min_length: minimum read length
+    :param max_length: maximum read length
+    :param error_rate: probability of a sequencing error at each base
+    :param enzyme_site: recognition site of the enzyme
+    :param map_length: length of the genome segment of each map
+    :param jitter: standard deviation of the label positions
+    :param seed: seed for the random number generator
+    :return: dictionary with the paths of the output files
+    """
+    rng = np.random.default_rng(seed)
+    genome = random_genome(rng, n_chromosomes, genome_size)
+    reads, read_truth = simulate_reads(rng, genome, coverage, min_length, max_length, error_rate)
+    maps, map_truth = simulate_cmap(rng, genome, enzyme_site, map_length, jitter)
+
+    paths = {'genome': '{}.genome.fa'.format(prefix),
+             'reads': '{}.reads.fa'.format(prefix),
+             'cmap': '{}.cmap'.format(prefix),
+             'truth': '{}.truth.tsv'.format(prefix)}
+    write_fasta(paths['genome'], genome)
+    write_fasta(paths['reads'], reads)
+    write_cmap(paths['cmap'], maps)
+    write_truth(paths['truth'], map_truth + read_truth)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a genome, long reads and a cmap with known placements.")
+    parser.add_argument("prefix", type=str, help="Prefix of the output files.")
+    parser.add_argument("--genome_size", "-g", type=int, default=1000000, help="Total length of the genome.")
+    parser.add_argument("--n_chromosomes", "-n", type=int, default=1, help="Number of chromosomes.")
+    parser.add_argument("--coverage", "-x", type=float, default=10, help="Read coverage.")
+    parser.add_argument("--min_length", type=int, default=40000, help="Minimum read length.")
+    parser.add_argument("--max_length", type=int, default=90000, help="Maximum read length.")
+    parser.add_argument("--error_rate", "-e", type=float, default=0.0, help="Sequencing error rate of the reads.")
+    parser.add_argument("--enzyme_site", type=str, default="CTTAAG", help="Recognition site of the enzyme, or comma-separated sites of several enzymes.")
+    parser.add_argument("--map_length", "-m", type=int, default=500000, help="Length of the genome segment per map.")
+    parser.add_argument("--jitter", "-j", type=float, default=200, help="Standard deviation of the label positions.")
+    parser.add_argument("--seed", "-s", type=int, default=1, help="Seed for the random number generator.")
+    args = parser.parse_args(sys.argv[1:])
+    paths = simulate(args.prefix, args.genome_size, args.n_chromosomes, args.coverage, args.min_length,
+                     args.max_length, args.error_rate, args.enzyme_site, args.map_length, args.jitter, args.seed)
+    for name in paths:
+        print("{}: {}".format(name, paths[name]))
+
+if __name__ == '__main__':
+    main()
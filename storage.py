@@ -0,0 +1,21 @@
+import importlib
+
+# Every storage backend is a module with the same functions:
+# write_lengths, write_kmers, read_kmers, read_positions, get_contig_list, get_contig_positions, write_overlaps,
+# read_overlaps, remove_kmers, remove_tables and copy_tables. Each of them takes the db_name (prefix) of the run as
+# first argument, except copy_tables which takes the db_name to copy from first.
+# write_overlaps takes an iterable of batches of overlap rows and writes each batch as it comes.
+# remove_kmers only marks k-mers as removed, and the other read functions skip the removed k-mers.
+BACKENDS = {'sqlite': 'storage_sqlite',
+            'columnar': 'storage_columnar'}
+
+
+def get_backend(storage_type):
+    """
+    Returns the module that implements the chosen storage backend
+    :param storage_type: sqlite or columnar
+    :return: backend module
+    """
+    if storage_type not in BACKENDS:
+        raise ValueError("Unknown storage type: {}. Choose from: {}".format(storage_type, ', '.join(BACKENDS)))
+    return importlib.import_module(BACKENDS[storage_type])
@@ -0,0 +1,294 @@
+import glob
+import os
+import shutil
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Each column of each table is stored as its own .npy file in the directory <db_name>_columnar and is memory-mapped
+# when it is read, so the data is not copied through a database between the stages of a round. Removed k-mers are
+# marked in the <table_type>.active column instead of being deleted.
+
+
+def get_path(db_name, table, column):
+    """
+    Returns the path of the .npy file of one column
+    :param db_name: prefix of the run
+    :param table: name of the table
+    :param column: name of the column
+    :return: path to the .npy file
+    """
+    return os.path.join("{}_columnar".format(db_name), "{}.{}.npy".format(table, column))
+
+
+def save_column(db_name, table, column, array):
+    """
+    Stores one column as a .npy file
+    :param db_name: prefix of the run
+    :param table: name of the table
+    :param column: name of the column
+    :param array: numpy array with the content of the column
+    :return: None
+    """
+    os.makedirs("{}_columnar".format(db_name), exist_ok=True)
+    np.save(get_path(db_name, table, column), array)
+
+
+def load_column(db_name, table, column, mmap_mode='r'):
+    """
+    Memory-maps one column from its .npy file
+    :param db_name: prefix of the run
+    :param table: name of the table
+    :param column: name of the column
+    :param mmap_mode: 'r' to read the column, 'r+' to change it in place
+    :return: numpy memmap with the content of the column
+    """
+    return np.load(get_path(db_name, table, column), mmap_mode=mmap_mode)
+
+
+def write_lengths(db_name, contig_length):
+    """
+    Stores the length of each cmap in the cmap_len table
+    :param db_name: prefix of the run
+    :param contig_length: Dictionary with format: {'contig/cmap name' : length of the cmap}
+    :return: None
+    """
+    save_column(db_name, 'cmap_len', 'contig', np.array(list(contig_length), dtype=str))
+    save_column(db_name, 'cmap_len', 'length', np.array(list(contig_length.values()), dtype=np.int64))
+
+
+def write_kmers(db_name, table_type, n_distances, kmer_batches):
+    """
+    Stores the distance k-mers and the positions belonging to them. The rows are the same as the rows of the
+    <table_type> and <table_type>_contigs sql tables. Each batch is turned into numpy blocks as it comes.
+    :param db_name: prefix of the run
+    :param table_type: fasta or cmap
+    :param n_distances: number of distances per row
+    :param kmer_batches: iterable of tuples with format (distances, sites), with distances a dictionary with format
+        {'congtig/cmap name' : [list of distances (ordered)]} and sites a dictionary with format:
+        {'contig/cmap name' : [ordered list of enzyme site locations]}
+    :return: number of k-mers written
+    """
+    contig_list = []
+    counts = []
+    distance_blocks = [np.zeros((0, n_distances), dtype=np.int32)]
+    position_blocks = [np.zeros((0, n_distances + 1), dtype=np.int32)]
+    for distances, sites in kmer_batches:
+        for contig in distances:
+            n_rows = len(distances[contig]) - n_distances
+            if n_rows <= 0:
+                continue
+            contig_list.append(contig)
+            counts.append(n_rows)
+            distance_blocks.append(
+                sliding_window_view(np.asarray(distances[contig], dtype=np.int32), n_distances)[:n_rows])
+            position_blocks.append(
+                sliding_window_view(np.asarray(sites[contig], dtype=np.int32), n_distances + 1)[:n_rows])
+
+    n_kmers = sum(counts)
+    save_column(db_name, table_type, 'id', np.arange(1, n_kmers + 1, dtype=np.int64))
+    save_column(db_name, table_type, 'contig', np.repeat(np.array(contig_list, dtype=str), counts))
+    save_column(db_name, table_type, 'pos_contig',
+                np.concatenate([np.arange(1, n + 1, dtype=np.int32) for n in counts] + [np.zeros(0, dtype=np.int32)]))
+    save_column(db_name, table_type, 'distances', np.concatenate(distance_blocks))
+    save_column(db_name, table_type, 'active', np.ones(n_kmers, dtype=bool))
+    save_column(db_name, '{}_contigs'.format(table_type), 'positions', np.concatenate(position_blocks))
+    return n_kmers
+
+
+def read_kmers(db_name, table_type):
+    """
+    Reads all distance k-mers that have not been removed
+    :param db_name: prefix of the run
+    :param table_type: fasta or cmap
+    :return: ids: numpy array with the id of each k-mer
+    :return: contig: numpy array with the contig/cmap name of each k-mer
+    :return: position_id: numpy array with the position id of each k-mer
+    :return: distances: 2D numpy array with format [[distance_1 distance_2 ... distance_n]], 1 row per k-mer
+    """
+    active = load_column(db_name, table_type, 'active')
+    ids = load_column(db_name, table_type, 'id')[active]
+    contig = load_column(db_name, table_type, 'contig')[active]
+    position_id = load_column(db_name, table_type, 'pos_contig')[active]
+    distances = load_column(db_name, table_type, 'distances')[active]
+    return ids, contig, position_id, distances
+
+
+def read_positions(db_name, table_type):
+    """
+    Reads the enzyme site positions of all k-mers, including the removed ones
+    :param db_name: prefix of the run
+    :param table_type: fasta or cmap
+    :return: np_positions: 2D numpy array with format [[pos_1 pos_2 ... pos_n]], 1 row per k-mer
+    :return: contig: numpy array with the contig/cmap name of each k-mer
+    :return: position_id: numpy array with the position id of each k-mer
+    """
+    np_positions = load_column(db_name, '{}_contigs'.format(table_type), 'positions')
+    contig = load_column(db_name, table_type, 'contig')
+    position_id = load_column(db_name, table_type, 'pos_contig')
+    return np_positions, contig, position_id
+
+
+def get_contig_starts(db_name, table_type):
+    """
+    Finds the first row of each contig/cmap. The rows of a contig are stored together and ordered by position id.
+    :param db_name: prefix of the run
+    :param table_type: fasta or cmap
+    :return: contig_names: numpy array with the contig/cmap names in the order they were stored
+    :return: starts: numpy array with the first row of each contig/cmap
+    """
+    contig = load_column(db_name, table_type, 'contig')
+    contig_names, starts = np.unique(contig, return_index=True)
+    order = np.argsort(starts)
+    return contig_names[order], starts[order]
+
+
+def get_contig_list(db_name, table_type):
+    """
+    Lists the names of all contigs/cmaps in the order they were stored
+    :param db_name: prefix of the run
+    :param table_type: fasta or cmap
+    :return: list of contig/cmap names
+    """
+    contig_names, starts = get_contig_starts(db_name, table_type)
+    return contig_names.tolist()
+
+
+def get_contig_positions(db_name, table_type):
+    """
+    Lists the position ids of the k-mers that have not been removed, per contig/cmap
+    :param db_name: prefix of the run
+    :param table_type: fasta or cmap
+    :return: dictionary with format {contig_name:[sorted position_ids]}
+    """
+    contig_names, starts = get_contig_starts(db_name, table_type)
+    active = load_column(db_name, table_type, 'active')
+    position_id = load_column(db_name, table_type, 'pos_contig')
+    contig_positions = {}
+    for contig, start, end in zip(contig_names.tolist(), starts, np.append(starts[1:], len(active))):
+        positions = position_id[start:end][active[start:end]]
+        if len(positions) > 0:
+            contig_positions[contig] = positions.tolist()
+    return contig_positions
+
+
+def write_overlaps(db_name, overlap_batches):
+    """
+    Replaces the stored overlaps with new overlaps. Each batch is stored as its own chunk of columns as it comes, so
+    only 1 batch is in memory. The overlaps of a fasta contig are consecutive rows, and the chunks and rows of each
+    fasta contig are kept in the overlap_index table, sorted by contig so read_overlaps finds a contig with a binary
+    search.
+    :param db_name: prefix of the run
+    :param overlap_batches: iterable of lists with format [[id, fasta_contig, fasta_id, fasta_loc, cmap_contig, cmap_id,
+        cmap_loc, deviation]]
+    :return: number of overlaps written
+    """
+    for path in glob.glob(get_path(db_name, 'overlap', '*')):
+        os.remove(path)
+    columns = ['id', 'fasta_contig', 'fasta_id', 'fasta_loc', 'cmap_contig', 'cmap_id', 'cmap_loc', 'deviation']
+    dtypes = [np.int64, str, np.int64, np.int32, str, np.int64, np.int32, np.int32]
+    index_contig = []
+    index_chunk = []
+    index_start = []
+    index_end = []
+    n_chunks = 0
+    n_overlaps = 0
+    for batch in overlap_batches:
+        if len(batch) == 0:
+            continue
+        table = 'overlap.{}'.format(n_chunks)
+        for i in range(len(columns)):
+            save_column(db_name, table, columns[i], np.array([v[i] for v in batch], dtype=dtypes[i]))
+        fasta_contig = np.array([v[1] for v in batch], dtype=str)
+        starts = np.append(0, np.nonzero(fasta_contig[1:] != fasta_contig[:-1])[0] + 1)
+        index_contig += fasta_contig[starts].tolist()
+        index_chunk += [n_chunks] * len(starts)
+        index_start += starts.tolist()
+        index_end += np.append(starts[1:], len(batch)).tolist()
+        n_chunks += 1
+        n_overlaps += len(batch)
+    index_contig = np.array(index_contig, dtype=str)
+    # a stable sort keeps the chunks of a contig that spans several batches in order
+    order = np.argsort(index_contig, kind='stable')
+    save_column(db_name, 'overlap_index', 'contig', index_contig[order])
+    save_column(db_name, 'overlap_index', 'chunk', np.array(index_chunk, dtype=np.int64)[order])
+    save_column(db_name, 'overlap_index', 'start', np.array(index_start, dtype=np.int64)[order])
+    save_column(db_name, 'overlap_index', 'end', np.array(index_end, dtype=np.int64)[order])
+    return n_overlaps
+
+
+def read_overlaps(db_name, fasta_contig, max_deviation=None):
+    """
+    Reads the overlaps of 1 fasta contig to all cmaps
+    :param db_name: prefix of the run
+    :param fasta_contig: name of the fasta contig of which overlapping sequences will be extracted
+    :param max_deviation: if given, only the overlaps with at most this deviation of which neither the fasta nor the
+        cmap k-mer has been removed are read
+    :return: fasta_loc: numpy array with the fasta position id of each overlap
+    :return: cmap_loc: numpy array with the cmap position id of each overlap
+    :return: cmap_contig: numpy array with the cmap name of each overlap
+    """
+    index_contig = load_column(db_name, 'overlap_index', 'contig')
+    index = slice(np.searchsorted(index_contig, fasta_contig, side='left'),
+                  np.searchsorted(index_contig, fasta_contig, side='right'))
+    chunks = load_column(db_name, 'overlap_index', 'chunk')[index]
+    starts = load_column(db_name, 'overlap_index', 'start')[index]
+    ends = load_column(db_name, 'overlap_index', 'end')[index]
+    if max_deviation is not None:
+        fasta_active = load_column(db_name, 'fasta', 'active')
+        cmap_active = load_column(db_name, 'cmap', 'active')
+
+    fasta_loc = [np.zeros(0, dtype=np.int32)]
+    cmap_loc = [np.zeros(0, dtype=np.int32)]
+    cmap_contig = [np.zeros(0, dtype=str)]
+    for chunk, start, end in zip(chunks, starts, ends):
+        table = 'overlap.{}'.format(chunk)
+        rows = slice(start, end)
+        if max_deviation is not None:
+            keep = load_column(db_name, table, 'deviation')[rows] <= max_deviation
+            # the id of a k-mer is its row + 1
+            keep &= fasta_active[load_column(db_name, table, 'fasta_id')[rows] - 1]
+            keep &= cmap_active[load_column(db_name, table, 'cmap_id')[rows] - 1]
+            rows = start + np.nonzero(keep)[0]
+        fasta_loc.append(np.array(load_column(db_name, table, 'fasta_loc')[rows]))
+        cmap_loc.append(np.array(load_column(db_name, table, 'cmap_loc')[rows]))
+        cmap_contig.append(np.array(load_column(db_name, table, 'cmap_contig')[rows]))
+    return np.concatenate(fasta_loc), np.concatenate(cmap_loc), np.concatenate(cmap_contig)
+
+
+def remove_kmers(db_name, table_type, remove_list):
+    """
+    Marks mapped k-mers as removed so they are not used in further alignment rounds
+    :param db_name: prefix of the run
+    :param table_type: fasta or cmap
+    :param remove_list: list with format [[contig_name, position_id]]
+    :return: None
+    """
+    if len(remove_list) == 0:
+        return
+    contig_names, starts = get_contig_starts(db_name, table_type)
+    first_row = dict(zip(contig_names.tolist(), starts.tolist()))
+    rows = [first_row[contig] + int(pos) - 1 for contig, pos in remove_list]
+    active = load_column(db_name, table_type, 'active', mmap_mode='r+')
+    active[rows] = False
+    active.flush()
+    del active
+
+
+def remove_tables(db_name):
+    """
+    Removes all tables of a run, so the index can be made again
+    :param db_name: prefix of the run
+    :return: None
+    """
+    shutil.rmtree("{}_columnar".format(db_name), ignore_errors=True)
+
+
+def copy_tables(source_db_name, db_name):
+    """
+    Replaces all tables of a run with a copy of the tables of another run
+    :param source_db_name: prefix of the run to copy
+    :param db_name: prefix of the run to replace
+    :return: None
+    """
+    remove_tables(db_name)
+    shutil.copytree("{}_columnar".format(source_db_name), "{}_columnar".format(db_name))
@@ -0,0 +1,252 @@
+import os
+import shutil
+import sqlite3
+import numpy as np
+import make_sql
+import process_cmap as pc
+
+sqlite3.register_adapter(np.int64, int)
+sqlite3.register_adapter(np.int32, int)
+
+
+def connect(db_name):
+    """
+    Opens a connection to the sql database of the run
+    :param db_name: name of the sql database
+    :return: connection to the sql database
+    """
+    return sqlite3.connect("{}.db".format(db_name))
+
+
+def write_lengths(db_name, contig_length):
+    """
+    Stores the length of each cmap in the cmap_len table
+    :param db_name: name of the sql database
+    :param contig_length: Dictionary with format: {'contig/cmap name' : length of the cmap}
+    :return: None
+    """
+    pc.make_length_table(contig_length, db_name)
+
+
+def write_kmers(db_name, table_type, n_distances, kmer_batches):
+    """
+    Stores the distance k-mers and the positions belonging to them in the <table_type> and <table_type>_contigs tables.
+    The batches are inserted as they come.
+    :param db_name: name of the sql database
+    :param table_type: fasta or cmap
+    :param n_distances: number of distances per row
+    :param kmer_batches: iterable of tuples with format (distances, sites), with distances a dictionary with format
+        {'congtig/cmap name' : [list of distances (ordered)]} and sites a dictionary with format:
+        {'contig/cmap name' : [ordered list of enzyme site locations]}
+    :return: number of k-mers written
+    """
+    return make_sql.make_db(kmer_batches, db_name, n_distances, table_type)
+
+
+def read_table(db_name, table, chunk_size=2**16):
+    """
+    Reads a k-mer or position table into numpy arrays in chunks of rows, so the table is never held in memory as python
+    tuples. Of a k-mer table only the k-mers that have not been removed are read.
+    :param db_name: name of the sql database
+    :param table: name of the table
+    :param chunk_size: number of rows fetched at a time
+    :return: ids: numpy array with the id of each row
+    :return: contig: numpy array with the contig/cmap name of each row
+    :return: position_id: numpy array with the position id of each row
+    :return: values: 2D numpy array with the distance or position columns, 1 row per row of the table
+    """
+    cursor = connect(db_name).cursor()
+    columns = [v[1] for v in cursor.execute("PRAGMA table_info({});".format(table))]
+    condition = ""
+    if 'active' in columns:
+        columns.remove('active')
+        condition = " WHERE active=1"
+    n_rows = cursor.execute("SELECT COUNT(*) FROM {}{};".format(table, condition)).fetchone()[0]
+    cursor.execute("SELECT {} FROM {}{};".format(', '.join(columns), table, condition))
+    n_values = len(columns) - 3
+
+    ids = np.zeros(n_rows, dtype=np.int64)
+    contig_codes = np.zeros(n_rows, dtype=np.int64)
+    position_id = np.zeros(n_rows, dtype=np.int32)
+    values = np.zeros((n_rows, n_values), dtype=np.int32)
+    contig_names = {}
+    start = 0
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        end = start + len(rows)
+        ids[start:end] = [v[0] for v in rows]
+        contig_codes[start:end] = [contig_names.setdefault(v[1], len(contig_names)) for v in rows]
+        position_id[start:end] = [v[2] for v in rows]
+        values[start:end] = [v[3:] for v in rows]
+        start = end
+    contig = np.array(list(contig_names), dtype=str)[contig_codes]
+    return ids, contig, position_id, values
+
+
+def read_kmers(db_name, table_type):
+    """
+    Reads all distance k-mers that have not been removed
+    :param db_name: name of the sql database
+    :param table_type: fasta or cmap
+    :return: ids: numpy array with the id of each k-mer
+    :return: contig: numpy array with the contig/cmap name of each k-mer
+    :return: position_id: numpy array with the position id of each k-mer
+    :return: distances: 2D numpy array with format [[distance_1 distance_2 ... distance_n]], 1 row per k-mer
+    """
+    ids, contig, position_id, distances = read_table(db_name, table_type)
+    return ids, contig, position_id, distances
+
+
+def read_positions(db_name, table_type):
+    """
+    Reads the enzyme site positions of all k-mers, including the removed ones
+    :param db_name: name of the sql database
+    :param table_type: fasta or cmap
+    :return: np_positions: 2D numpy array with format [[pos_1 pos_2 ... pos_n]], 1 row per k-mer
+    :return: contig: numpy array with the contig/cmap name of each k-mer
+    :return: position_id: numpy array with the position id of each k-mer
+    """
+    ids, contig, position_id, np_positions = read_table(db_name, "{}_contigs".format(table_type))
+    return np_positions, contig, position_id
+
+
+def get_contig_list(db_name, table_type):
+    """
+    Lists the names of all contigs/cmaps in the order they were stored
+    :param db_name: name of the sql database
+    :param table_type: fasta or cmap
+    :return: list of contig/cmap names
+    """
+    cursor = connect(db_name).cursor()
+    rows = cursor.execute("SELECT contig FROM {}_contigs;".format(table_type))
+    return list(dict.fromkeys(v[0] for v in rows))
+
+
+def get_contig_positions(db_name, table_type):
+    """
+    Lists the position ids of the k-mers that have not been removed, per contig/cmap
+    :param db_name: name of the sql database
+    :param table_type: fasta or cmap
+    :return: dictionary with format {contig_name:[sorted position_ids]}
+    """
+    cursor = connect(db_name).cursor()
+    cmd = """SELECT contig, pos_contig FROM {}
+            WHERE active=1
+            ORDER BY contig, pos_contig ASC;""".format(table_type)
+    contig_positions = {}
+    for contig, pos in cursor.execute(cmd):
+        if contig not in contig_positions:
+            contig_positions[contig] = []
+        contig_positions[contig].append(pos)
+    return contig_positions
+
+
+def write_overlaps(db_name, overlap_batches):
+    """
+    Replaces the overlap table with new overlaps. The batches are inserted as they come, so only 1 batch is in memory.
+    :param db_name: name of the sql database
+    :param overlap_batches: iterable of lists with format [[id, fasta_contig, fasta_id, fasta_loc, cmap_contig, cmap_id,
+        cmap_loc, deviation]]
+    :return: number of overlaps written
+    """
+    connection = connect(db_name)
+    cursor = connection.cursor()
+    cursor.execute("""DROP TABLE IF EXISTS overlap""")
+
+    create_overlap_table = """
+    CREATE TABLE overlap (
+    id INT PRIMARY KEY,
+    fasta_contig VARCHAR(255) NOT NULL,
+    fasta_id INT NOT NULL,
+    fasta_loc INT NOT NULL,
+    cmap_contig VARCHAR(255) NOT NULL,
+    cmap_id INT NOT NULL,
+    cmap_loc INT NOT NULL,
+    deviation INT NOT NULL
+    );
+    """
+    cursor.execute(create_overlap_table)
+    n_overlaps = 0
+    for batch in overlap_batches:
+        cursor.executemany('INSERT INTO overlap VALUES (?,?,?,?,?,?,?,?)', batch)
+        n_overlaps += len(batch)
+    connection.commit()
+    return n_overlaps
+
+
+def read_overlaps(db_name, fasta_contig, max_deviation=None):
+    """
+    Reads the overlaps of 1 fasta contig to all cmaps
+    :param db_name: name of the sql database
+    :param fasta_contig: name of the fasta contig of which overlapping sequences will be extracted
+    :param max_deviation: if given, only the overlaps with at most this deviation of which neither the fasta nor the
+        cmap k-mer has been removed are read
+    :return: fasta_loc: numpy array with the fasta position id of each overlap
+    :return: cmap_loc: numpy array with the cmap position id of each overlap
+    :return: cmap_contig: numpy array with the cmap name of each overlap
+    """
+    cursor = connect(db_name).cursor()
+    if max_deviation is None:
+        cmd = """SELECT fasta_loc, cmap_loc, cmap_contig FROM overlap
+            WHERE fasta_contig=?
+            ORDER BY fasta_loc;"""
+        rows = cursor.execute(cmd, (fasta_contig,)).fetchall()
+    else:
+        cmd = """SELECT overlap.fasta_loc, overlap.cmap_loc, overlap.cmap_contig FROM overlap
+            JOIN fasta ON fasta.id = overlap.fasta_id
+            JOIN cmap ON cmap.id = overlap.cmap_id
+            WHERE overlap.fasta_contig=? AND overlap.deviation<=? AND fasta.active=1 AND cmap.active=1
+            ORDER BY overlap.fasta_loc;"""
+        rows = cursor.execute(cmd, (fasta_contig, max_deviation)).fetchall()
+
+    fasta_loc = np.array([v[0] for v in rows], dtype=np.int64)
+    cmap_loc = np.array([v[1] for v in rows], dtype=np.int64)
+    cmap_contig = np.array([v[2] for v in rows], dtype=str)
+    return fasta_loc, cmap_loc, cmap_contig
+
+
+def remove_kmers(db_name, table_type, remove_list):
+    """
+    Marks mapped k-mers as removed so they are not used in further alignment rounds. The rows are updated by their
+    primary key, so the time taken depends on the number of removed k-mers and not on the size of the table.
+    :param db_name: name of the sql database
+    :param table_type: fasta or cmap
+    :param remove_list: list with format [[contig_name, position_id]]
+    :return: None
+    """
+    if len(remove_list) == 0:
+        return
+    connection = connect(db_name)
+    cursor = connection.cursor()
+
+    first_id = {}
+    for contig in set(contig for contig, pos in remove_list):
+        first_id[contig] = cursor.execute("SELECT first_id FROM {}_first_id WHERE contig=?;".format(table_type),
+                                          (contig,)).fetchone()[0]
+    remove_cmd = """
+        UPDATE {} SET active=0
+        WHERE id=?""".format(table_type)
+    cursor.executemany(remove_cmd, ((first_id[contig] + int(pos) - 1,) for contig, pos in remove_list))
+    connection.commit()
+
+
+def remove_tables(db_name):
+    """
+    Removes all tables of a run, so the index can be made again
+    :param db_name: name of the sql database
+    :return: None
+    """
+    if os.path.exists("{}.db".format(db_name)):
+        os.remove("{}.db".format(db_name))
+
+
+def copy_tables(source_db_name, db_name):
+    """
+    Replaces all tables of a run with a copy of the tables of another run
+    :param source_db_name: name of the sql database to copy
+    :param db_name: name of the sql database to replace
+    :return: None
+    """
+    shutil.copyfile("{}.db".format(source_db_name), "{}.db".format(db_name))